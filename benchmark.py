@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# To see the full help, type: ./benchmark.py --help
+
+"""
+Measures how edx-presenter.py scales.
+
+The script generates a synthetic course of many groups and builds it with edx-presenter.py.
+Each stage of the build (acquire, load, render, archive) is measured by the spans of --profile,
+and the wall time, the peak RSS and the size of the output of each stage are written as JSON.
+"""
+
+
+# Handles command line arguments
+from optparse import OptionParser
+
+# Logging functionality of python.
+import logging
+
+# Packages for file and process operatons
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+import multiprocessing
+import resource
+import traceback
+
+# misc
+import imp
+import json
+import random
+import binascii
+
+# PyYAML is required by edx-presenter.py as well.
+import yaml
+
+
+(script_directory , filename) = os.path.split(os.path.realpath(__file__))
+
+# The script has a dash in its name, so it can't be imported by the import statement.
+presenter = imp.load_source('edx_presenter', os.path.join(script_directory, 'edx-presenter.py'))
+
+
+def random_bytes(rnd, size):
+	"""Returns size pseudo random bytes, which are reproducible by the seed of rnd."""
+	chunks = []
+	while size > 0:
+		n = min(size, 64 * 1024)
+		chunks.append(binascii.unhexlify('%0*x' % (2 * n, rnd.getrandbits(8 * n))))
+		size -= n
+	return ''.join(chunks)
+
+
+def random_source(rnd, size):
+	"""Returns about size bytes of python source."""
+	lines = []
+	length = 0
+	while length < size:
+		line = "def function_{0}(x):\n\treturn x * {1} + {2}\n\n".format(len(lines), rnd.randint(0, 1000), rnd.randint(0, 1000))
+		lines.append(line)
+		length += len(line)
+	return ''.join(lines)
+
+
+def write_file(path, data):
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as f:
+		f.write(data)
+
+
+def generate_group(path, index, options, rnd):
+	"""Generates the group number index inside the directory path."""
+	content = [{'text': 'docs/intro.txt'}]
+	write_file(os.path.join(path, 'docs', 'intro.txt'), "Group {0}\n\n{1}".format(index, random_source(rnd, 1024)))
+
+	for i in range(options.pdfs):
+		name = 'docs/paper{0}.pdf'.format(i)
+		write_file(os.path.join(path, *name.split('/')), random_bytes(rnd, options.pdf_size * 1024))
+		content.append({'pdf': name})
+
+	for i in range(options.files):
+		name = 'data/file{0}.dat'.format(i)
+		write_file(os.path.join(path, *name.split('/')), random_bytes(rnd, options.file_size * 1024))
+		content.append({'file': name})
+
+	# The files of a source tree vary in size between 1 KB and --source-size.
+	for i in range(options.sources):
+		name = 'src{0}/'.format(i)
+		for j in range(options.source_files):
+			module = os.path.join(path, name, 'package{0}'.format(j % 4), 'module{0}.py'.format(j))
+			write_file(module, random_source(rnd, rnd.randint(1, options.source_size) * 1024))
+		content.append({'source': name})
+
+	group = {
+		'project': 'Project {0}'.format(index % options.projects),
+		'group': 'Group {0:04d}'.format(index),
+		'authors': [{'name': 'Author {0}'.format(index), 'email': 'author{0}@example.org'.format(index)}],
+		'content': content,
+	}
+	with open(os.path.join(path, 'group.yaml'), 'w') as f:
+		yaml.safe_dump(group, f, default_flow_style=False)
+
+	if options.git:
+		subprocess.check_call(['git', 'init', '-q', path])
+		subprocess.check_call(['git', '-C', path, 'add', '-A'])
+		subprocess.check_call(['git', '-C', path, '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@example.org', 'commit', '-q', '-m', 'Synthetic group'])
+		return 'file://' + os.path.abspath(path)
+	return path
+
+
+def generate_course(path, options):
+	"""Generates the groups of the synthetic course inside path and returns their sources."""
+	rnd = random.Random(options.seed)
+	sources = []
+	for index in range(options.groups):
+		sources.append(generate_group(os.path.join(path, 'group{0:04d}'.format(index)), index, options, rnd))
+	return sources
+
+
+def directory_size(path):
+	"""Returns the number of bytes of all files below path."""
+	size = 0
+	for root, _, files in os.walk(path):
+		for name in files:
+			size += os.lstat(os.path.join(root, name)).st_size
+	return size
+
+
+class StageProfiler(presenter.Profiler):
+	"""A Profiler which records the peak RSS at the end of each span of the 'stage' category."""
+
+	def add(self, name, category, start, end, args):
+		if category == 'stage':
+			# ru_maxrss is the high-water mark of the process, so it includes all earlier stages.
+			# The children are the GIT processes and the worker processes of --processes.
+			args['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			args['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+		presenter.Profiler.add(self, name, category, start, end, args)
+
+
+def stage_results(events):
+	"""Returns the wall time, the peak RSS and the output size of each stage recorded by the spans of the 'stage' category."""
+	stages = []
+	for e in events:
+		if e['cat'] == 'stage':
+			stages.append({
+				'stage': e['name'],
+				'seconds': e['dur'] / 1e6,
+				'peak_rss_kb': e['args']['peak_rss_kb'],
+				'children_peak_rss_kb': e['args']['children_peak_rss_kb'],
+				'output_bytes': e['args'].get('bytes'),
+			})
+	return stages
+
+
+def build(sources, work_dir, options):
+	"""Builds the course of sources with edx-presenter.py and returns the measured stages."""
+	build_options = presenter.default_options(
+		output=os.path.join(work_dir, 'to_import.tar.gz'),
+		# Without --stream, the course is rendered into the directory work_dir/display_name and compressed afterwards like --tmp does.
+		tmp=None if options.stream else work_dir,
+		jobs=options.jobs,
+		processes=options.processes,
+		compression_level=options.compression_level,
+		gzip_threads=options.gzip_threads,
+		bundle_compression=options.bundle_compression,
+		write_queue=options.write_queue)
+	settings = presenter.Settings.from_options(build_options)
+
+	# The stages are the spans of --profile, see edx-presenter.py main().
+	presenter.profiler = StageProfiler()
+	subprocess_setting = {'stderr':subprocess.PIPE, 'stdout':subprocess.PIPE}
+
+	acquire_dir = os.path.join(work_dir, 'acquire')
+	os.makedirs(acquire_dir)
+	with presenter.span('acquire', 'stage'):
+		paths = presenter.acquire_sources(sources, acquire_dir, subprocess_setting, options.jobs)
+
+	with presenter.span('load', 'stage'):
+		projects = presenter.load_projects(paths, settings)
+
+	presenter.build_course(projects, build_options, settings, work_dir)
+
+	stages = stage_results(presenter.profiler.take())
+	for stage in stages:
+		if stage['stage'] == 'acquire':
+			stage['output_bytes'] = directory_size(acquire_dir)
+		elif stage['stage'] == 'archive':
+			stage['output_bytes'] = os.path.getsize(build_options.output)
+	return stages
+
+
+def build_process(sources, work_dir, options, conn):
+	"""Runs build() inside a process of its own, so the peak RSS of each run is independent of the others."""
+	try:
+		conn.send((build(sources, work_dir, options), None))
+	except:
+		conn.send((None, traceback.format_exc()))
+	conn.close()
+
+
+def main():
+
+	# The following block parses the arguments supplied.
+	parser = OptionParser(usage="usage: %prog [options]")
+	parser.add_option("-v", "--verbose",
+	                  action="count", dest="verbose", default=False,
+	                  help="Increase verbosity (specify multiple times for more)")
+	parser.add_option("-o", "--output",
+	                  metavar="FILE", dest="output",
+	                  help="Writes the results as JSON to FILE instead of the standard output.")
+	parser.add_option("--tmp",
+	                  metavar="DIR", dest="tmp",
+	                  help="""Configures the directory to use for the generated course and the builds.
+If set, this direcory will not be deleted. If not specified,
+a temporary directory is created by the operating system and deleted.
+""")
+	parser.add_option("--groups", default=20, type="int",
+	                  metavar="N", dest="groups",
+	                  help="Number of generated groups. [default: %default]")
+	parser.add_option("--projects", default=4, type="int",
+	                  metavar="N", dest="projects",
+	                  help="Number of projects the groups are distributed to. [default: %default]")
+	parser.add_option("--pdfs", default=2, type="int",
+	                  metavar="N", dest="pdfs",
+	                  help="Number of 'pdf' content items per group. [default: %default]")
+	parser.add_option("--pdf-size", default=512, type="int",
+	                  metavar="KB", dest="pdf_size",
+	                  help="Size of each Pdf. [default: %default]")
+	parser.add_option("--files", default=2, type="int",
+	                  metavar="N", dest="files",
+	                  help="Number of 'file' content items per group. [default: %default]")
+	parser.add_option("--file-size", default=256, type="int",
+	                  metavar="KB", dest="file_size",
+	                  help="Size of each data file. [default: %default]")
+	parser.add_option("--sources", default=1, type="int",
+	                  metavar="N", dest="sources",
+	                  help="Number of 'source' content items per group. [default: %default]")
+	parser.add_option("--source-files", default=20, type="int",
+	                  metavar="N", dest="source_files",
+	                  help="Number of files of each source tree. [default: %default]")
+	parser.add_option("--source-size", default=32, type="int",
+	                  metavar="KB", dest="source_size",
+	                  help="Maximal size of a source file, the sizes vary between 1 KB and KB. [default: %default]")
+	parser.add_option("--seed", default=0, type="int",
+	                  metavar="N", dest="seed",
+	                  help="Seed of the generated content. [default: %default]")
+	parser.add_option("--git", action="store_true", default=False,
+	                  dest="git",
+	                  help="Makes each group a GIT repository, so the acquire stage clones them.")
+	parser.add_option("-r", "--repeat", default=1, type="int",
+	                  metavar="N", dest="repeat",
+	                  help="Number of builds of the generated course. [default: %default]")
+	parser.add_option("-j", "--jobs", default=1, type="int",
+	                  metavar="N", dest="jobs",
+	                  help="Passed to edx-presenter.py. [default: %default]")
+	parser.add_option("-p", "--processes", default=1, type="int",
+	                  metavar="N", dest="processes",
+	                  help="Passed to edx-presenter.py. [default: %default]")
+	parser.add_option("--compression-level", default=9, type="int",
+	                  metavar="N", dest="compression_level",
+	                  help="Passed to edx-presenter.py. [default: %default]")
+	parser.add_option("--gzip-threads", default=1, type="int",
+	                  metavar="N", dest="gzip_threads",
+	                  help="Passed to edx-presenter.py. [default: %default]")
+	parser.add_option("--bundle-compression", default="gz", type="choice", choices=["gz", "none"],
+	                  dest="bundle_compression",
+	                  help="Passed to edx-presenter.py. [default: %default]")
+	parser.add_option("--write-queue", default=presenter.Settings().write_queue_limit / (1024 * 1024), type="int",
+	                  metavar="MB", dest="write_queue",
+	                  help="Passed to edx-presenter.py. [default: %default]")
+	parser.add_option("--stream", action="store_true", default=False,
+	                  dest="stream",
+	                  help="Streams the files into the archive like edx-presenter.py without --tmp. The archive stage only finishes the archive then.")
+	(options, _) = parser.parse_args()
+
+	# Setting up the logging facility.
+	log_level = logging.WARNING
+	if options.verbose == 1:
+		log_level = logging.INFO
+	elif options.verbose >= 2:
+		log_level = logging.DEBUG
+	logging.basicConfig(stream=sys.stderr, level=log_level)
+
+	if options.groups < 1 or options.projects < 1:
+		parser.error("--groups and --projects expect a positive number.")
+
+	if options.repeat < 1:
+		parser.error("--repeat expects a positive number.")
+
+	# Setup of our temorary directory, where we do all the file processing.
+	if options.tmp is None:
+		tmp_dir = tempfile.mkdtemp()
+	else:
+		tmp_dir = options.tmp
+		if not os.path.exists(tmp_dir):
+			os.makedirs(tmp_dir)
+	logging.debug("tmp directory %s", tmp_dir)
+
+	try:
+		course_dir = os.path.join(tmp_dir, 'course')
+		if os.path.exists(course_dir):
+			shutil.rmtree(course_dir)
+		logging.info("Generating %d groups in %s", options.groups, course_dir)
+		sources = generate_course(course_dir, options)
+
+		runs = []
+		for i in range(options.repeat):
+			work_dir = os.path.join(tmp_dir, 'run{0}'.format(i))
+			if os.path.exists(work_dir):
+				shutil.rmtree(work_dir)
+			os.makedirs(work_dir)
+
+			logging.info("Build %d of %d", i + 1, options.repeat)
+			(parent, child) = multiprocessing.Pipe(False)
+			p = multiprocessing.Process(target=build_process, args=(sources, work_dir, options, child))
+			p.start()
+			child.close()
+			(stages, error) = parent.recv()
+			p.join()
+			if error is not None:
+				logging.error("The build failed:\n%s", error)
+				sys.exit(1)
+
+			runs.append({'seconds': sum(stage['seconds'] for stage in stages), 'stages': stages})
+			shutil.rmtree(work_dir)
+
+		result = {
+			'options': vars(options),
+			'course': {'groups': options.groups, 'bytes': directory_size(course_dir)},
+			'runs': runs,
+		}
+		if options.output is None:
+			json.dump(result, sys.stdout, indent=2, sort_keys=True)
+			sys.stdout.write('\n')
+		else:
+			with open(options.output, 'w') as f:
+				json.dump(result, f, indent=2, sort_keys=True)
+
+	# If any expection occurs, we still want to delete the temporary directory.
+	finally:
+		if options.tmp is None:
+			shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+	main()
@@ -52,8 +52,8 @@ Workflow
 1. A temporary directory is created
 2. All GIT sources are cloned inside this temporary directory
 3. The 'group.yaml' of each group is interpreted to build the data tree.
-4. A edx directory is created inside the temporary directory, into which all the data is processed
-5. The edx directory gets compressed
+4. All the data is processed into the edx course, which is streamed directly into the compressed archive
+5. With --tmp, the edx course is written to a directory inside the temporary directory instead, which then gets compressed
 
 
 The source is in 3 parts (reversed to the workflow)
@@ -67,6 +67,9 @@ Group and project is represented by a class.
 Part 3:
 Contains the __main__ method and does the GIT handling
 
+Other tools may build a course inside their own process with build(), see make.py. The settings of a course are
+kept by a Settings object of each group, not in module variables, so a process may build several courses.
+
 
 """
 
@@ -88,18 +91,42 @@ import re
 import sys
 import os
 import tarfile
+import gzip
 import subprocess
 import shutil
 import tempfile
+import threading
+import time
+import io
+import errno
+import hashlib
+
+# Concurrent acquisition of the sources
+from multiprocessing.pool import ThreadPool
+
+# Parallel rendering of the groups
+import multiprocessing
 
 # utf-8 support
 import codecs
 
 # misc
+import zipfile
+import stat
 import uuid
+import zlib
+import collections
+import json
+import mmap
+import contextlib
 import operator
 import cgi
 import urlparse
+import copy
+
+# The build service of --serve
+import BaseHTTPServer
+import SocketServer
 
 # PyYAML is not a core module.
 try:
@@ -111,6 +138,74 @@ $ pip install pyyaml
 """
 	sys.exit(1)
 
+# fcntl is not available on Windows. Without it, the caches are only locked against the threads of this process,
+# and files are never reflinked, see cache_lock() and copy_file().
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Pygments is optional. Without it, the source is shown without highlighting.
+try:
+	import pygments
+	from pygments.lexers import PythonLexer
+	from pygments.formatters import HtmlFormatter
+except ImportError:
+	pygments = None
+
+
+
+# The Profiler recording the spans of --profile, see span(). It's set by main() only.
+profiler = None
+
+
+class Settings(object):
+	"""The settings of a generated course, see from_options().
+
+	Each Group keeps the settings it's rendered with. Nothing is kept in module variables,
+	so a process may build several courses with different settings, see build()."""
+
+	def __init__(self):
+		self.course_url = None
+		self.bundle_compression = 'gz'
+		# The maximal number of characters of a single file and of all files shown by a 'source' page.
+		self.source_file_limit = 100 * 1024
+		self.source_page_limit = 1024 * 1024
+		# The directory keeping the archives of 'source' content, see cached_bundle().
+		self.bundle_cache = None
+		# The directory keeping the highlighted source, see highlight().
+		self.highlight_cache = None
+		# Files above static_file_limit bytes aren't included in the course. With asset_url, they are linked to asset_url
+		# and collected in the directory asset_dir for the upload, see Content.static_file().
+		self.static_file_limit = None
+		self.asset_url = None
+		self.asset_dir = None
+		# The maximal number of bytes queued for writing in the background, see WriteBehindSink. 0 writes synchronously.
+		self.write_queue_limit = 16 * 1024 * 1024
+
+	@classmethod
+	def from_options(cls, options):
+		"""Returns the settings of the options of the command line, see default_options(). Creates the cache directories."""
+		settings = cls()
+		settings.course_url = options.course_url
+		settings.bundle_compression = options.bundle_compression
+		settings.source_file_limit = options.max_source_file_size * 1024
+		settings.source_page_limit = options.max_source_page_size * 1024
+		settings.write_queue_limit = options.write_queue * 1024 * 1024
+
+		if options.max_static_file_size is not None:
+			settings.static_file_limit = options.max_static_file_size * 1024 * 1024
+		settings.asset_url = options.asset_url
+		settings.asset_dir = os.path.abspath(shard_path(options.output, 'assets', ''))
+
+		if options.cache_dir is not None:
+			# Keeps the cached paths valid independent of the working directory.
+			cache_dir = os.path.abspath(options.cache_dir)
+			settings.bundle_cache = os.path.join(cache_dir, 'bundles')
+			ensure_dir(settings.bundle_cache)
+			settings.highlight_cache = os.path.join(cache_dir, 'highlight')
+			ensure_dir(settings.highlight_cache)
+		return settings
 
 
 def escape(string):
@@ -118,48 +213,955 @@ def escape(string):
 	return cgi.escape(string).encode('ascii', 'xmlcharrefreplace')
 
 
+# --- Output -----------------------------------------------------------------
+
+# The ioctl cloning a file on copy-on-write filesystems like btrfs or xfs, see ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+def link_file(source_path, target):
+	"""Creates the file target with the content of source_path.
+
+	A hardlink or a reflink is preferred over copying the bytes, if the filesystem allows it."""
+	ensure_dir(os.path.dirname(target))
+	try:
+		os.link(source_path, target)
+		return
+	except OSError:
+		pass
+	copy_file(source_path, target)
+
+
+def copy_file(source_path, target):
+	"""Creates the file target with the content of source_path, which is independent of later changes to source_path.
+
+	A reflink is preferred over copying the bytes, if the filesystem allows it. Unlike a hardlink, it doesn't share the inode."""
+	ensure_dir(os.path.dirname(target))
+	with open(source_path, 'rb') as src:
+		with open(target, 'wb') as dst:
+			if fcntl is not None:
+				try:
+					fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+					return
+				except (IOError, OSError):
+					pass
+			shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+# The buffer size for copying files.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# The digests computed by file_digest(), keyed by the path, size, modification time and inode of the file.
+_file_digests = {}
+
+def file_digest(path):
+	"""Returns the SHA-1 digest of the content of the file path.
+
+	The digest is remembered, so each file is only read once per run, whether it's hashed for the
+	static file name, the render cache or a source bundle. Large files are mapped into memory
+	and hashed without copying them through read()."""
+	path = os.path.abspath(path)
+	st = os.stat(path)
+	key = (path, st.st_size, st.st_mtime, st.st_ino)
+	digest = _file_digests.get(key)
+	if digest is not None:
+		return digest
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		if st.st_size >= COPY_BUFFER_SIZE:
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				sha1.update(m)
+			finally:
+				m.close()
+		else:
+			sha1.update(f.read())
+	digest = sha1.hexdigest()
+	_file_digests[key] = digest
+	return digest
+
+
+def walk_tree(path):
+	"""Yields the path and all the directories, files and symbolic links below it in a stable order."""
+	for dirname, dirnames, filenames in os.walk(path):
+		yield dirname
+		dirnames.sort()
+		# os.walk() doesn't descend into symbolic links to directories, but we still want the links.
+		links = [d for d in dirnames if os.path.islink(os.path.join(dirname, d))]
+		for filename in sorted(filenames + links):
+			yield os.path.join(dirname, filename)
+
+
+def tree_digest(path, file_digest=file_digest):
+	"""Returns the digest of the names, executable bits and contents of everything below the directory path."""
+	digest = hashlib.sha1()
+	for path_full in walk_tree(path):
+		path_relative = os.path.relpath(path_full, path)
+		if os.path.islink(path_full):
+			entry = [path_relative, 'link', os.readlink(path_full)]
+		elif os.path.isdir(path_full):
+			entry = [path_relative, 'dir']
+		else:
+			entry = [path_relative, bool(os.stat(path_full).st_mode & 0111), file_digest(path_full)]
+		digest.update(json.dumps(entry))
+	return digest.hexdigest()
+
+
+def write_bundle(path, fileobj, compress=True):
+	"""Writes a reproducible tar archive of the directory path into fileobj.
+
+	The members are sorted and their owners, modes and modification times are normalized, so the
+	same files always give the same bytes. The gzip header has neither a timestamp nor a filename."""
+	root = os.path.basename(os.path.normpath(path))
+	gz = None
+	if compress:
+		gz = fileobj = gzip.GzipFile(filename='', mode='wb', fileobj=fileobj, mtime=0)
+	tar = tarfile.open(fileobj=fileobj, mode='w|')
+	for path_full in walk_tree(path):
+		path_relative = os.path.relpath(path_full, path)
+		arcname = root if path_relative == '.' else root + '/' + path_relative.replace(os.sep, '/')
+		info = tar.gettarinfo(path_full, arcname)
+		info.mtime = 0
+		info.uid = info.gid = 0
+		info.uname = info.gname = ''
+		if info.isdir() or (info.isreg() and info.mode & 0111):
+			info.mode = 0755
+		elif info.isreg():
+			info.mode = 0644
+		if info.isreg():
+			with open(path_full, 'rb') as f:
+				tar.addfile(info, f)
+		else:
+			tar.addfile(info)
+	tar.close()
+	if gz is not None:
+		gz.close()
+
+
+def cached_bundle(path, cache_dir, compress=True):
+	"""Returns a bundle of the directory path, see write_bundle().
+
+	The bundles are kept inside cache_dir under the name and the tree_digest() of the directory, so an
+	unchanged directory is never compressed again. The name is the root of the bundle, which tree_digest() doesn't cover."""
+	root = os.path.basename(os.path.normpath(path))
+	if isinstance(root, unicode):
+		root = root.encode('utf-8')
+	key = hashlib.sha1(root + '\0' + tree_digest(path)).hexdigest()
+	bundle = os.path.join(cache_dir, key + ('.tar.gz' if compress else '.tar'))
+	if not os.path.exists(bundle):
+		partial = '{0}.{1}.partial'.format(bundle, uuid.uuid4())
+		with open(partial, 'wb') as f:
+			write_bundle(path, f, compress)
+		os.rename(partial, bundle)
+	return bundle
+
+class DirectorySink:
+	"""Writes the generated files of the course into a directory."""
+
+	def __init__(self, path):
+		self.path = path
+		# The directories created so far, each one is only checked once.
+		self.directories = set()
+
+	def open(self, name):
+		"""Returns a binary file for writing the file 'name' relative to the course directory."""
+		path = os.path.join(self.path, *name.split('/'))
+		directory = os.path.dirname(path)
+		if directory not in self.directories:
+			ensure_dir(directory)
+			self.directories.add(directory)
+		return open(path, 'wb')
+
+	def write(self, name, data):
+		with self.open(name) as f:
+			f.write(data)
+
+	def copy(self, name, source_path):
+		with open(source_path, 'rb') as src:
+			with self.open(name) as dst:
+				shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+	def move(self, name, source_path):
+		"""Like copy(), but source_path may be moved instead."""
+		path = os.path.join(self.path, *name.split('/'))
+		ensure_dir(os.path.dirname(path))
+		try:
+			os.rename(source_path, path)
+		except OSError:
+			self.copy(name, source_path)
+
+	def link(self, name, source_path):
+		"""Like copy(), but for files named by their content: An existing file is kept and the file is linked if possible."""
+		path = os.path.join(self.path, *name.split('/'))
+		if not os.path.exists(path):
+			link_file(source_path, path)
+
+	def close(self):
+		pass
+
+
+class StagingSink(DirectorySink):
+	"""A DirectorySink which remembers the names of the written files in order.
+
+	Each name is remembered once, as files named by their content may be linked several times."""
+
+	def __init__(self, path):
+		DirectorySink.__init__(self, path)
+		self.names = []
+		self.known = set()
+
+	def remember(self, name):
+		if name not in self.known:
+			self.known.add(name)
+			self.names.append(name)
+
+	def open(self, name):
+		self.remember(name)
+		return DirectorySink.open(self, name)
+
+	def link(self, name, source_path):
+		self.remember(name)
+		DirectorySink.link(self, name, source_path)
+
+
+class TarMember:
+	"""A file of a TarSink. The content is spooled until the file is closed, because a tar header needs the size upfront."""
+
+	def __init__(self, sink, name):
+		self.sink = sink
+		self.name = name
+		self.spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+	def write(self, data):
+		self.spool.write(data)
+
+	def close(self):
+		if self.spool is None:
+			return
+		size = self.spool.tell()
+		self.spool.seek(0)
+		self.sink.add(self.name, self.spool, size)
+		self.spool.close()
+		self.spool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.spool.close()
+
+
+def _gzip_block(block, compresslevel):
+	"Compresses block into a complete gzip member."
+	compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipWriter:
+	"""A writable file, which compresses the data in blocks by several threads.
+
+	Each block becomes a gzip member of its own. A concatenation of gzip members is a valid gzip
+	file (RFC 1952), which gzip, tar and Python's gzip/tarfile read like a single member.
+	zlib releases the GIL while compressing, so the threads make use of several cores."""
+
+	BLOCK_SIZE = 1024 * 1024
+
+	def __init__(self, fileobj, compresslevel=9, threads=2, close_fileobj=True):
+		self.fileobj = fileobj
+		self.close_fileobj = close_fileobj
+		self.compresslevel = compresslevel
+		self.threads = threads
+		self.pool = ThreadPool(threads)
+		self.pending = collections.deque()
+		self.buffer = []
+		self.buffered = 0
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= self.BLOCK_SIZE:
+			self._submit()
+
+	def _submit(self):
+		block = ''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		self.pending.append(self.pool.apply_async(_gzip_block, (block, self.compresslevel)))
+		# The members are written in order. At most two blocks per thread are kept in memory.
+		while len(self.pending) > 2 * self.threads:
+			self.fileobj.write(self.pending.popleft().get())
+
+	def close(self):
+		if self.buffered:
+			self._submit()
+		while self.pending:
+			self.fileobj.write(self.pending.popleft().get())
+		self.pool.close()
+		self.pool.join()
+		if self.close_fileobj:
+			self.fileobj.close()
+
+
+class ParallelGzipTarFile(tarfile.TarFile):
+	"""A tar archive streamed into a ParallelGzipWriter, see open_archive()."""
+
+	def close(self):
+		try:
+			tarfile.TarFile.close(self)
+		finally:
+			self.writer.close()
+
+
+def open_archive(path, compresslevel=9, threads=1, fileobj=None):
+	"""Opens the gzip compressed tar archive path for writing. With more than one thread, it's compressed in parallel.
+
+	If fileobj is given, the archive is streamed into it instead, and path is None. fileobj is left open."""
+	if threads > 1:
+		if fileobj is None:
+			writer = ParallelGzipWriter(open(path, 'wb'), compresslevel, threads)
+		else:
+			writer = ParallelGzipWriter(fileobj, compresslevel, threads, close_fileobj=False)
+		tar = ParallelGzipTarFile.open(mode='w|', fileobj=writer)
+		tar.writer = writer
+		return tar
+	return tarfile.open(path, "w:gz", fileobj=fileobj, compresslevel=compresslevel)
+
+
+class TarSink:
+	"""Streams the generated files of the course directly into a compressed tar archive.
+
+	A file is only added once. Files shared by several groups are named by their content,
+	the names of all the other files are unique."""
+
+	def __init__(self, path, root, compresslevel=9, threads=1, fileobj=None):
+		self.root = root
+		self.tar = open_archive(path, compresslevel, threads, fileobj)
+		self.names = set()
+		self.directories = set()
+		self.lock = threading.Lock()
+		self.mtime = time.time()
+
+	def _directory(self, name):
+		"Adds the directory entries for name and its parents, unless already added. Expects the lock."
+		if name in self.directories:
+			return
+		parent = os.path.dirname(name)
+		if parent:
+			self._directory(parent)
+		info = tarfile.TarInfo(name)
+		info.type = tarfile.DIRTYPE
+		info.mode = 0755
+		info.mtime = self.mtime
+		self.tar.addfile(info)
+		self.directories.add(name)
+
+	def add(self, name, fileobj, size):
+		"""Adds the file 'name' with size bytes read from fileobj."""
+		arcname = self.root + '/' + name
+		info = tarfile.TarInfo(arcname)
+		info.size = size
+		info.mode = 0644
+		info.mtime = self.mtime
+		with self.lock:
+			if name in self.names:
+				return
+			self.names.add(name)
+			self._directory(os.path.dirname(arcname))
+			self.tar.addfile(info, fileobj)
+
+	def open(self, name):
+		"""Returns a binary file for writing the file 'name' relative to the course directory."""
+		return TarMember(self, name)
+
+	def write(self, name, data):
+		self.add(name, io.BytesIO(data), len(data))
+
+	def copy(self, name, source_path):
+		with open(source_path, 'rb') as src:
+			self.add(name, src, os.fstat(src.fileno()).st_size)
+
+	def move(self, name, source_path):
+		"""Like copy(), but source_path may be moved instead."""
+		self.copy(name, source_path)
+
+	def link(self, name, source_path):
+		"""Like copy(), but for files named by their content."""
+		if name not in self.names:
+			self.copy(name, source_path)
+
+	def close(self):
+		self.tar.close()
+
+
+class TeeFile:
+	"""A writable file forwarding everything to several files."""
+
+	def __init__(self, *files):
+		self.files = files
+
+	def write(self, data):
+		for f in self.files:
+			f.write(data)
+
+	def close(self):
+		for f in self.files:
+			f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		for f in self.files:
+			f.__exit__(exc_type, exc_value, traceback)
+
+
+class RecordingSink:
+	"""Forwards the generated files to the sink out and keeps a copy of them in the directory path.
+
+	The copies are never hardlinks, an input file edited in place would change the recorded item otherwise."""
+
+	def __init__(self, out, path):
+		self.out = out
+		self.record = DirectorySink(path)
+
+	def open(self, name):
+		return TeeFile(self.out.open(name), self.record.open(name))
+
+	def write(self, name, data):
+		self.out.write(name, data)
+		self.record.write(name, data)
+
+	def copy(self, name, source_path):
+		self.out.copy(name, source_path)
+		copy_file(source_path, os.path.join(self.record.path, *name.split('/')))
+
+	def link(self, name, source_path):
+		self.out.link(name, source_path)
+		copy_file(source_path, os.path.join(self.record.path, *name.split('/')))
+
+	def close(self):
+		pass
+
+
+class CountingFile:
+	"""A writable file counting the bytes written to it for a CountingSink."""
+
+	def __init__(self, sink, f):
+		self.sink = sink
+		self.f = f
+
+	def write(self, data):
+		self.sink.written += len(data)
+		self.f.write(data)
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.f.__exit__(exc_type, exc_value, traceback)
+
+
+class CountingSink:
+	"""Forwards the generated files to the sink out and counts their bytes, see span()."""
+
+	def __init__(self, out):
+		self.out = out
+		self.written = 0
+
+	def open(self, name):
+		return CountingFile(self, self.out.open(name))
+
+	def write(self, name, data):
+		self.written += len(data)
+		self.out.write(name, data)
+
+	def copy(self, name, source_path):
+		self.written += os.path.getsize(source_path)
+		self.out.copy(name, source_path)
+
+	def move(self, name, source_path):
+		self.written += os.path.getsize(source_path)
+		self.out.move(name, source_path)
+
+	def link(self, name, source_path):
+		self.written += os.path.getsize(source_path)
+		self.out.link(name, source_path)
+
+	def close(self):
+		self.out.close()
+
+
+class WriteBehindFile:
+	"""A writable file of a WriteBehindSink, which waits for the queued files before it is closed."""
+
+	def __init__(self, sink, f):
+		self.sink = sink
+		self.f = f
+
+	def write(self, data):
+		self.f.write(data)
+
+	def close(self):
+		self.sink.flush()
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.sink.flush()
+		self.f.__exit__(exc_type, exc_value, traceback)
+
+
+class WriteBehindSink:
+	"""Hands the generated files to a background thread, which writes them into the sink out.
+
+	Rendering proceeds while the files are written. The thread writes everything queued so far as
+	one batch, in the order of the calls, and at most limit bytes are queued. Files written through
+	open() are streamed into out directly, once the queue is empty. The first error of the thread
+	is raised by the next call, at the latest by flush() or close()."""
+
+	def __init__(self, out, limit=16 * 1024 * 1024):
+		self.out = out
+		self.limit = limit
+		self.queue = collections.deque()
+		# The bytes and the number of the files queued or being written.
+		self.queued = 0
+		self.pending = 0
+		self.error = None
+		self.closed = False
+		self.condition = threading.Condition()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _wait(self):
+		"Waits for the thread. Expects the condition. The timeout keeps the main thread responsive to Ctrl-C."
+		self.condition.wait(1)
+
+	def _raise(self):
+		"Raises the error of the thread, if any. Expects the condition."
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+
+	def _put(self, size, method, *args):
+		with self.condition:
+			while self.pending > 0 and self.queued + size > self.limit and self.error is None:
+				self._wait()
+			self._raise()
+			self.queue.append((size, method, args))
+			self.queued += size
+			self.pending += 1
+			self.condition.notify_all()
+
+	def _run(self):
+		while True:
+			with self.condition:
+				while not self.queue and not self.closed:
+					self._wait()
+				if not self.queue:
+					return
+				batch = list(self.queue)
+				self.queue.clear()
+				skip = self.error is not None
+			error = None
+			if not skip:
+				try:
+					for (_, method, args) in batch:
+						method(*args)
+				except Exception:
+					error = sys.exc_info()
+			with self.condition:
+				self.queued -= sum(size for (size, _, _) in batch)
+				self.pending -= len(batch)
+				if error is not None:
+					self.error = error
+				self.condition.notify_all()
+
+	def flush(self):
+		"""Waits until all queued files are written."""
+		with self.condition:
+			while self.pending > 0:
+				self._wait()
+			self._raise()
+
+	def open(self, name):
+		self.flush()
+		return WriteBehindFile(self, self.out.open(name))
+
+	def write(self, name, data):
+		self._put(len(data), self.out.write, name, data)
+
+	def copy(self, name, source_path):
+		self._put(0, self.out.copy, name, source_path)
+
+	def move(self, name, source_path):
+		# The caller may delete the directory of source_path right afterwards.
+		self.flush()
+		self.out.move(name, source_path)
+
+	def link(self, name, source_path):
+		self._put(0, self.out.link, name, source_path)
+
+	def close(self):
+		"""Writes the queued files, stops the thread and closes out."""
+		if self.closed:
+			return
+		try:
+			self.flush()
+		finally:
+			with self.condition:
+				self.closed = True
+				self.condition.notify_all()
+			self.thread.join()
+			self.out.close()
+
+
+class Profiler:
+	"""Records spans of the build as Chrome trace events, which trace viewers like chrome://tracing open.
+
+	The worker processes of a ParallelRenderer record their own spans, which are added by merge()."""
+
+	def __init__(self):
+		self.events = []
+
+	def add(self, name, category, start, end, args):
+		self.events.append({'name':name, 'cat':category, 'ph':'X', 'ts':int(start * 1e6), 'dur':int((end - start) * 1e6),
+		                    'pid':os.getpid(), 'tid':threading.current_thread().ident, 'args':args})
+
+	def take(self):
+		"""Returns and forgets the events recorded since the last call."""
+		events = self.events
+		self.events = []
+		return events
+
+	def merge(self, events):
+		self.events.extend(events)
+
+	def save(self, path):
+		with open(path, 'w') as f:
+			json.dump({'traceEvents':self.events, 'displayTimeUnit':'ms'}, f)
+
+	def summary(self, limit=10):
+		"""Prints the slowest groups."""
+		groups = sorted((e for e in self.events if e['cat'] == 'group'), key=operator.itemgetter('dur'), reverse=True)
+		stages = [e for e in self.events if e['cat'] == 'stage']
+		if stages:
+			print "Stages:"
+			for e in stages:
+				print "  {0:<10} {1:>10.3f} s".format(e['name'], e['dur'] / 1e6)
+		if groups:
+			print "Slowest groups:"
+			print "  {0:<50} {1:>10} {2:>12}".format('Group', 'Seconds', 'Bytes')
+			for e in groups[:limit]:
+				print "  {0:<50} {1:>10.3f} {2:>12}".format(e['name'][:50].encode('ascii', 'replace'), e['dur'] / 1e6, e['args'].get('bytes', ''))
+
+
+@contextlib.contextmanager
+def span(name, category, out=None, **args):
+	"""Records the enclosed block as a span if --profile is given. args are stored with the span.
+
+	If out is a CountingSink, the span records the bytes written to it as well."""
+	if profiler is None:
+		yield
+		return
+	written = getattr(out, 'written', None)
+	start = time.time()
+	try:
+		yield
+	finally:
+		if written is not None:
+			args['bytes'] = out.written - written
+		profiler.add(name, category, start, time.time(), args)
+
+
+class RenderCache:
+	"""Keeps the generated files of each content item for incremental builds.
+
+	The files are stored under a digest of everything the item depends on: its type and
+	parameters, the properties of its group, the course URL and the content of its inputs.
+	A manifest records the digests of each group and content item, together with the size
+	and modification time of each hashed file, so unchanged files aren't hashed again."""
+
+	# Increment whenever the generated files change for the same input.
+	VERSION = 3
+
+	def __init__(self, path):
+		self.path = path
+		self.items_dir = os.path.join(path, 'items')
+		ensure_dir(self.items_dir)
+		self.manifest_path = os.path.join(path, 'manifest.json')
+		self.manifest = {'version':self.VERSION, 'groups':{}, 'files':{}}
+		if os.path.exists(self.manifest_path):
+			with open(self.manifest_path, 'r') as f:
+				manifest = json.load(f)
+			if manifest.get('version') == self.VERSION:
+				self.manifest = manifest
+		# The results of this run, see results()
+		self.groups = {}
+		self.hashed = {}
+		self.reused = 0
+		self.rendered = 0
+
+	def file_digest(self, path):
+		"""Returns the SHA-1 digest of the file path, reusing the manifest if size and mtime are unchanged."""
+		path = os.path.abspath(path)
+		st = os.stat(path)
+		known = self.manifest['files'].get(path)
+		if known is not None and known[0] == st.st_size and known[1] == st.st_mtime:
+			self.hashed[path] = known
+			return known[2]
+		digest = file_digest(path)
+		self.hashed[path] = [st.st_size, st.st_mtime, digest]
+		return digest
+
+	def input_digest(self, path):
+		"""Returns the digest of the file or of all the files below the directory path."""
+		# A missing input is reported by the content item, when it's rendered.
+		if not os.path.exists(path):
+			return 'missing'
+		if not os.path.isdir(path):
+			return self.file_digest(path)
+		return tree_digest(path, self.file_digest)
+
+	def digest(self, content):
+		"""Returns the digest of all the inputs of the content item."""
+		group = content.parent
+		settings = group.settings
+		# JSON doesn't distinguish str and unicode, which the manifest and PyYAML mix.
+		digest = hashlib.sha1()
+		highlighter = pygments.__version__ if pygments is not None else None
+		digest.update(json.dumps([self.VERSION, content.__class__.__name__, content.url_name(), settings.course_url, settings.bundle_compression,
+		                          settings.source_file_limit, settings.source_page_limit, highlighter, settings.static_file_limit, settings.asset_url]))
+		digest.update(json.dumps(content.params(), sort_keys=True))
+		digest.update(json.dumps(dict((k, v) for (k, v) in group.properties.items() if k != 'content'), sort_keys=True))
+		for path in content.inputs():
+			digest.update(self.input_digest(os.path.join(group.path, path)))
+		return digest.hexdigest()
+
+	def render(self, content, out):
+		"""Writes the files of the content item into the sink out, from the cache if possible."""
+		digest = self.digest(content)
+		item_dir = os.path.join(self.items_dir, digest)
+
+		if os.path.exists(item_dir):
+			names = []
+			for dirname, dirnames, filenames in os.walk(item_dir):
+				for filename in filenames:
+					names.append(os.path.relpath(os.path.join(dirname, filename), item_dir).replace(os.sep, '/'))
+			for name in sorted(names):
+				out.link(name, os.path.join(item_dir, *name.split('/')))
+			# The files linked externally aren't part of the item.
+			content.collect_external_files()
+			self.reused += 1
+		else:
+			# The files are recorded next to the final location, so an interrupted item is never reused.
+			partial = os.path.join(self.items_dir, '{0}.{1}.partial'.format(digest, uuid.uuid4()))
+			content.edx(RecordingSink(out, partial))
+			try:
+				os.rename(partial, item_dir)
+			except OSError:
+				# The same item was rendered concurrently.
+				shutil.rmtree(partial)
+			self.rendered += 1
+		return digest
+
+	def render_group(self, group, out):
+		"""Writes the files of all the content items of the group into the sink out."""
+		items = {}
+		for c in group.content:
+			with span(c.url_name(), 'content', out, type=c.__class__.__name__):
+				items[c.url_name()] = self.render(c, out)
+		self.groups[group.url_name()] = {'path':os.path.abspath(group.path), 'items':items}
+
+	def results(self):
+		"""Returns and resets the results collected since the last call. Used by the worker processes of a ParallelRenderer."""
+		results = (self.groups, self.hashed, self.reused, self.rendered)
+		self.groups = {}
+		self.hashed = {}
+		self.reused = 0
+		self.rendered = 0
+		return results
+
+	def merge(self, results):
+		"""Adds the results() of a worker process."""
+		(groups, hashed, reused, rendered) = results
+		self.groups.update(groups)
+		self.hashed.update(hashed)
+		self.reused += reused
+		self.rendered += rendered
+
+	def save(self):
+		"""Writes the manifest and deletes the items no group refers to anymore."""
+		self.manifest['groups'].update(self.groups)
+		used = set()
+		for group in self.manifest['groups'].values():
+			used.update(group['items'].values())
+		for name in os.listdir(self.items_dir):
+			if name not in used and not name.endswith('.partial'):
+				shutil.rmtree(os.path.join(self.items_dir, name))
+		# Only the files of this run are kept, the checkouts of remote sources change their path every run.
+		self.manifest['files'] = self.hashed
+		with open(self.manifest_path + '.partial', 'w') as f:
+			json.dump(self.manifest, f)
+		os.rename(self.manifest_path + '.partial', self.manifest_path)
+		logging.info("Reused %d and rendered %d content items.", self.reused, self.rendered)
+		# --watch saves the cache after each build.
+		self.results()
+
+
+def highlight(source, cache_dir=None):
+	"""Returns the python source as HTML, highlighted if Pygments is available and escaped otherwise.
+
+	The highlighted source is kept inside cache_dir, if given, under the digest of the source,
+	so unchanged files are never tokenized again."""
+	if pygments is None:
+		return '<pre>' + escape(source) + '</pre>'
+
+	path = None
+	if cache_dir is not None:
+		key = hashlib.sha1(pygments.__version__ + '\0' + source.encode('utf-8')).hexdigest()
+		path = os.path.join(cache_dir, key + '.html')
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				return f.read()
+
+	html = pygments.highlight(source, PythonLexer(), HtmlFormatter()).encode('ascii', 'xmlcharrefreplace')
+	if path is not None:
+		partial = '{0}.{1}.partial'.format(path, uuid.uuid4())
+		with open(partial, 'wb') as f:
+			f.write(html)
+		os.rename(partial, path)
+	return html
+
+
+def write_xml(out, name, element):
+	"Writes the XML element as the file 'name' into the sink out."
+	f = io.BytesIO()
+	ElementTree(element).write(f)
+	out.write(name, f.getvalue())
+
+
+def write_html(out, name, html):
+	"Writes the html string as the UTF-8 encoded file 'name' into the sink out."
+	if isinstance(html, unicode):
+		html = html.encode('utf-8')
+	out.write(name, html)
+
+
 # --- Part 1 -----------------------------------------------------------------
 
-class ContentDiscussion:
+# The patterns of url_name(): Just keeps the basic ASCII characters. It removes any whitespaces and umlauts.
+URL_NAME_PATTERN = re.compile(r'\W+')
+FILE_URL_NAME_PATTERN = re.compile(r'[^(\w|.)]+')
 
-	def __init__(self, parent):
+
+class Content(object):
+	"""The base class of the content items of a group.
+
+	A course may have tens of thousands of content items, so they only keep their parameters from
+	the group definition in slots. The url_name is computed once, when the group is loaded."""
+
+	__slots__ = ('parent', '_url_name')
+
+	def __init__(self, parent, suffix, pattern=URL_NAME_PATTERN):
 		self.parent = parent
+		self._url_name = pattern.sub('', parent.url_name() + suffix)
 
 	def url_name(self):
-		"Using the fact, that there is exactly one discussion for each group."
-		return re.sub(r'\W+', '', self.parent.url_name() + '_discussion')
+		return self._url_name
+
+	def params(self):
+		"The parameters of this item from the group definition."
+		return dict((name, getattr(self, name)) for name in self.__slots__)
+
+	def static_file(self, out, path, extension):
+		"""Stores the file path in the static directory and returns its URL and its name.
+
+		The file is named by its content, so a file shared by several groups is stored just once.
+		A file larger than the static_file_limit of the Settings is refused, or linked to their asset_url if given."""
+		settings = self.parent.settings
+		size = os.path.getsize(path)
+		if settings.static_file_limit is not None and size > settings.static_file_limit and settings.asset_url is None:
+			raise SubprocessError("The file {0} has {1:.1f} MB, more than --max-static-file-size. Use --asset-url to link it externally.".format(path, size / 1048576.0))
+
+		if settings.static_file_limit is None or size <= settings.static_file_limit:
+			target_filename = file_digest(path) + extension
+			out.link("static/{0}".format(target_filename), path)
+			return ("/static/" + target_filename, target_filename)
+		return self.external_file(path, extension)
+
+	def external_file(self, path, extension):
+		"""Collects the file path in the asset_dir of the Settings and returns its URL at their asset_url and its name.
+
+		The directory is written outside of the sink, so collect_external_files() repeats this for an item reused by the RenderCache."""
+		settings = self.parent.settings
+		target_filename = file_digest(path) + extension
+		target = os.path.join(settings.asset_dir, target_filename)
+		if not os.path.exists(target):
+			link_file(path, target)
+		url = settings.asset_url.rstrip('/') + '/' + target_filename
+		logging.warning("The file %s has %.1f MB and is linked to %s. Upload the files of %s there.", path, os.path.getsize(path) / 1048576.0, url, settings.asset_dir)
+		return (url, target_filename)
+
+	def static_files(self):
+		"The files, with their extension, which edx() stores by static_file()."
+		return []
+
+	def collect_external_files(self):
+		"""Collects the static_files() which are linked externally, like edx() does."""
+		settings = self.parent.settings
+		if settings.static_file_limit is None or settings.asset_url is None:
+			return
+		for (path, extension) in self.static_files():
+			if os.path.getsize(path) > settings.static_file_limit:
+				self.external_file(path, extension)
+
+	def inputs(self):
+		"The files and directories, relative to the group, which edx() reads."
+		return []
+
+	def parent_tag(self, xml):
+		"Adds the XML element pointing to this resoure to the vertical."
+		e = SubElement(xml, 'html', {'url_name':self.url_name()})
+
+
+class ContentDiscussion(Content):
 
-	def edx(self, out_dir):
-		discussion_dir = os.path.join(out_dir, 'discussion')
-		if not os.path.exists(discussion_dir):
-			os.makedirs(discussion_dir)
+	__slots__ = ()
+
+	def __init__(self, parent):
+		# Using the fact, that there is exactly one discussion for each group.
+		Content.__init__(self, parent, '_discussion')
+
+	def edx(self, out):
 		discussion = Element('discussion', {'discussion_id':self.url_name()});
-		tree = ElementTree(discussion)
-		tree.write(os.path.join(discussion_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "discussion/{0}.xml".format(self.url_name()), discussion)
 
 	def parent_tag(self, xml):
 		"Adds the XML element pointing to this resoure to the vertical."
 		e = SubElement(xml, 'discussion', {'url_name':self.url_name()})
 
 
-class ContentIntro:
+class ContentIntro(Content):
 
-	def __init__(self, parent):
-		self.parent = parent
+	__slots__ = ()
 
-	def url_name(self):
-		"Using the fact, that there is exactly one intro for each group."
-		return re.sub(r'\W+', '', self.parent.url_name() + '_intro')
+	def __init__(self, parent):
+		# Using the fact, that there is exactly one intro for each group.
+		Content.__init__(self, parent, '_intro')
 
-	def edx(self, out_dir):
+	def edx(self, out):
 
 		# Create the HTML-page with the details
-		html_dir = os.path.join(out_dir, 'html')
-		if not os.path.exists(html_dir):
-			os.makedirs(html_dir)
 		html = Element('html', {'filename':self.url_name(), 'display_name':"Intro"});
-		tree = ElementTree(html)
-		tree.write(os.path.join(html_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "html/{0}.xml".format(self.url_name()), html)
 
 		#Create the corresponding html-file
 		html = '''<h2>%(project)s: %(group)s</h2>
@@ -170,171 +1172,171 @@ class ContentIntro:
 			html += '<li><a href="mailto:%(email)s">%(name)s</a></li>' %  { 'email':escape(author['email']), 'name':escape(author['name']) }
 		html += '</ul></div>'
 
-		with codecs.open(os.path.join(html_dir, "{0}.html".format(self.url_name())), mode='w', encoding='utf-8') as f:
-			f.write(html)
+		write_html(out, "html/{0}.html".format(self.url_name()), html)
 
-	def parent_tag(self, xml):
-		"Adds the XML element pointing to this resoure to the vertical."
-		e = SubElement(xml, 'html', {'url_name':self.url_name()})
 
+class ContentHTML(Content):
 
-class ContentHTML:
+	__slots__ = ('path',)
 
 	def __init__(self, parent, path):
 		logging.debug("ContentHTML:__init__ %s", path)
-		self.parent = parent
+		Content.__init__(self, parent, '_html_' + path)
 		self.path = path
 
-	def url_name(self):
-		return re.sub(r'\W+', '', self.parent.url_name() + '_html_' + self.path)
+	def inputs(self):
+		"The files and directories, relative to the group, which edx() reads."
+		return [self.path]
 
-	def edx(self, out_dir):
-		html_dir = os.path.join(out_dir, 'html')
-		if not os.path.exists(html_dir):
-			os.makedirs(html_dir)
+	def edx(self, out):
 		html = Element('html', {'filename':self.url_name(), 'display_name':"HTML"});
-		tree = ElementTree(html)
-		tree.write(os.path.join(html_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "html/{0}.xml".format(self.url_name()), html)
 
 		#Copy the corresponding html-file
-		shutil.copyfile(os.path.join(self.parent.path, self.path), os.path.join(html_dir, "{0}.html".format(self.url_name())) );
+		out.copy("html/{0}.html".format(self.url_name()), os.path.join(self.parent.path, self.path))
 
-	def parent_tag(self, xml):
-		"Adds the XML element pointing to this resoure to the vertical."
-		e = SubElement(xml, 'html', {'url_name':self.url_name()})
 
+class ContentFile(Content):
 
-class ContentFile:
+	__slots__ = ('path',)
 
 	def __init__(self, parent, path):
 		logging.debug("ContentFile:__init__ %s", path)
-		self.parent = parent
+		fileName, fileExtension = os.path.splitext(path)
+		Content.__init__(self, parent, '_' + fileName, FILE_URL_NAME_PATTERN)
 		self.path = path
 
-	def url_name(self):
-		fileName, fileExtension = os.path.splitext(self.path)
-		return re.sub(r'[^(\w|.)]+', '', self.parent.url_name() + '_' + fileName)
+	def inputs(self):
+		"The files and directories, relative to the group, which edx() reads."
+		return [self.path]
 
-	def edx(self, out_dir):
-		# Copy the Pdf to the static directory
-		static_dir = os.path.join(out_dir, 'static')
-		if not os.path.exists(static_dir):
-			os.makedirs(static_dir)
-		# In order to get an unique filename inside edx, we have to prefix the project and group name
+	def static_files(self):
+		"The files, with their extension, which edx() stores by static_file()."
 		_, fileExtension = os.path.splitext(self.path)
-		target_filename = self.url_name()+fileExtension
-		target_path = os.path.join(static_dir,target_filename)
-		shutil.copyfile(os.path.join(self.parent.path, self.path), target_path);
+		return [(os.path.join(self.parent.path, self.path), fileExtension)]
+
+	def edx(self, out):
+		# Copy the file to the static directory
+		[(path_complete, fileExtension)] = self.static_files()
+		(url, _) = self.static_file(out, path_complete, fileExtension)
 
-		html_dir = os.path.join(out_dir, 'html')
-		if not os.path.exists(html_dir):
-			os.makedirs(html_dir)
 		html = Element('html', {'filename':self.url_name(), 'display_name':"File"});
-		tree = ElementTree(html)
-		tree.write(os.path.join(html_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "html/{0}.xml".format(self.url_name()), html)
 
 
+		# The download attribute restores the original filename.
 		(_ , filename) = os.path.split(self.path)
 		html = '''
-		<a href="/static/%(file)s">Download %(filename)s</a>
-		''' % {'file':target_filename, 'filename':filename}
+		<a href="%(url)s" download="%(filename)s">Download %(filename)s</a>
+		''' % {'url':escape(url), 'filename':escape(filename)}
 
-		with codecs.open(os.path.join(html_dir, "{0}.html".format(self.url_name())), mode='w', encoding='utf-8') as f:
-			f.write(html)
+		write_html(out, "html/{0}.html".format(self.url_name()), html)
 
-	def parent_tag(self, xml):
-		"Adds the XML element pointing to this resoure to the vertical."
-		e = SubElement(xml, 'html', {'url_name':self.url_name()})
 
+class ContentSource(Content):
 
-class ContentSource:
+	__slots__ = ('path',)
 
 	def __init__(self, parent, path):
 		logging.debug("ContentSource:__init__ %s", path)
-		self.parent = parent
+		Content.__init__(self, parent, '_source_' + path)
 		self.path = path
 
-	def url_name(self):
-		return re.sub(r'\W+', '', self.parent.url_name() + '_source_' + self.path)
+	def inputs(self):
+		"The files and directories, relative to the group, which edx() reads."
+		return [self.path]
 
-	def edx(self, out_dir):
+	def edx(self, out):
 
+		settings = self.parent.settings
 		# Path of the source directory relative to our working directory
 		path_complete = os.path.join(self.parent.path, self.path)
+		if not os.path.isdir(path_complete):
+			raise SubprocessError("The source directory {0} of the group at {1} doesn't exist.".format(self.path, self.parent.path))
 
 		# Create a archive with the source inside the static directory
-		static_dir = os.path.join(out_dir, 'static')
-		if not os.path.exists(static_dir):
-			os.makedirs(static_dir)
 		# In order to get an unique filename inside edx, we have to prefix the project and group name
-		target_filename = self.url_name()+'.tar.gz'
-		target_path = os.path.join(static_dir, target_filename)
-		tar = tarfile.open(target_path, "w:gz")
-		tar.add(path_complete, arcname=os.path.basename(path_complete))
-		tar.close()
+		# The course archive is compressed anyway, so compressing the source archive can be turned off.
+		compress = settings.bundle_compression != 'none'
+		target_filename = self.url_name() + ('.tar.gz' if compress else '.tar')
+		if settings.bundle_cache is not None:
+			out.copy("static/{0}".format(target_filename), cached_bundle(path_complete, settings.bundle_cache, compress))
+		else:
+			with out.open("static/{0}".format(target_filename)) as f:
+				write_bundle(path_complete, f, compress)
 
 
-		html_dir = os.path.join(out_dir, 'html')
-		if not os.path.exists(html_dir):
-			os.makedirs(html_dir)
 		html = Element('html', {'filename':self.url_name(), 'display_name':"Source"});
-		tree = ElementTree(html)
-		tree.write(os.path.join(html_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "html/{0}.xml".format(self.url_name()), html)
 
-		html = '''<h3>Source of %(path)s</h3>
-		''' % {'path':escape(self.path) }
+		# The page is written while the files are read. Files longer than source_file_limit characters are cut,
+		# and once the page holds source_page_limit characters of source, the remaining files are just listed.
+		with out.open("html/{0}.html".format(self.url_name())) as f:
+			f.write('''<h3>Source of %(path)s</h3>
+			''' % {'path':escape(self.path) })
 
-		html += '''
-		<a href="/static/%(file)s">Download source as archive</a>
-		''' % {'file':target_filename}
+			download = '''<a href="/static/%(file)s">Download source as archive</a>''' % {'file':target_filename}
+			f.write('''
+			%(download)s
+			''' % {'download':download})
 
-		for dirname, dirnames, filenames in os.walk(os.path.join(self.parent.path, self.path)):
+			# The source is highlighted at build time, the page just needs the style sheet.
+			if pygments is not None:
+				f.write('<style>%(css)s</style>' % {'css':HtmlFormatter().get_style_defs('.highlight')})
 
-			# Process each file
-			for filename in filenames:
+			page_size = 0
+			omitted = []
+			for dirname, dirnames, filenames in os.walk(os.path.join(self.parent.path, self.path)):
+				dirnames.sort()
 
-				#ignore any non-python file
-				if not filename.endswith('.py') or filename.startswith('.'):
-					continue
+				# Process each file
+				for filename in sorted(filenames):
 
-				path_full = os.path.join(dirname, filename)
-				# This path is relative to the group definition
-				path_relative = path_full[len(self.parent.path):]
+					#ignore any non-python file
+					if not filename.endswith('.py') or filename.startswith('.'):
+						continue
 
-				html += '<h3>%(path)s</h3>\n' % {'path':escape(path_relative)}
+					path_full = os.path.join(dirname, filename)
+					# This path is relative to the group definition
+					path_relative = path_full[len(self.parent.path):]
 
-				# It would be better to control the font-size by the theme
-				html += '<script src="https://google-code-prettify.googlecode.com/svn/loader/run_prettify.js?skin=tomorrow"></script>'
-				html += '<pre class="prettyprint python">'
-				with codecs.open(path_full, mode='r', encoding='utf-8') as f:
-					html += escape(f.read())
-				html += '</pre>'
+					if page_size >= settings.source_page_limit:
+						omitted.append(path_relative)
+						continue
 
-		with codecs.open(os.path.join(html_dir, "{0}.html".format(self.url_name())), mode='w', encoding='utf-8') as f:
-			f.write(html)
+					f.write('<h3>%(path)s</h3>\n' % {'path':escape(path_relative)})
+					# io.open() reads characters, codecs.open() doesn't.
+					with io.open(path_full, mode='r', encoding='utf-8') as src:
+						source = src.read(min(settings.source_file_limit, settings.source_page_limit - page_size))
+						truncated = src.read(1) != ''
+					f.write(highlight(source, settings.highlight_cache))
+					page_size += len(source)
+					if truncated:
+						f.write('<p>The file is truncated. %(download)s for the complete file.</p>' % {'download':download})
 
-	def parent_tag(self, xml):
-		"Adds the XML element pointing to this resoure to the vertical."
-		e = SubElement(xml, 'html', {'url_name':self.url_name()})
+			if omitted:
+				f.write('<p>The following files are too long to be shown. %(download)s for them.</p><ul>' % {'download':download})
+				for path_relative in omitted:
+					f.write('<li>%(path)s</li>' % {'path':escape(path_relative)})
+				f.write('</ul>')
 
 
-class ContentText:
+class ContentText(Content):
+
+	__slots__ = ('path',)
 
 	def __init__(self, parent, path):
 		logging.debug("ContentText:__init__ %s", path)
-		self.parent = parent
+		Content.__init__(self, parent, '_text_' + path)
 		self.path = path
 
-	def url_name(self):
-		return re.sub(r'\W+', '', self.parent.url_name() + '_text_' + self.path)
+	def inputs(self):
+		"The files and directories, relative to the group, which edx() reads."
+		return [self.path]
 
-	def edx(self, out_dir):
-		html_dir = os.path.join(out_dir, 'html')
-		if not os.path.exists(html_dir):
-			os.makedirs(html_dir)
+	def edx(self, out):
 		html = Element('html', {'filename':self.url_name(), 'display_name':"Text"});
-		tree = ElementTree(html)
-		tree.write(os.path.join(html_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "html/{0}.xml".format(self.url_name()), html)
 
 		html = ''
 		html += '<div>'
@@ -342,31 +1344,21 @@ class ContentText:
 			html += re.sub('\n', '<br/>',escape(f.read()) )
 		html += '</div>'
 
-		with codecs.open(os.path.join(html_dir, "{0}.html".format(self.url_name())), mode='w', encoding='utf-8') as f:
-			f.write(html)
+		write_html(out, "html/{0}.html".format(self.url_name()), html)
 
-	def parent_tag(self, xml):
-		"Adds the XML element pointing to this resoure to the vertical."
-		e = SubElement(xml, 'html', {'url_name':self.url_name()})
 
+class ContentVideoYouTube(Content):
 
-class ContentVideoYouTube:
+	__slots__ = ('youtube_id',)
 
 	def __init__(self, parent, youtube_id):
 		logging.debug("ContentVideoYouTube:__init__ %s", youtube_id)
-		self.parent = parent
+		Content.__init__(self, parent, '_youtube_' + youtube_id)
 		self.youtube_id = youtube_id
 
-	def url_name(self):
-		return re.sub(r'\W+', '', self.parent.url_name() + '_youtube_' + self.youtube_id)
-
-	def edx(self, out_dir):
-		video_dir = os.path.join(out_dir, 'video')
-		if not os.path.exists(video_dir):
-			os.makedirs(video_dir)
+	def edx(self, out):
 		video = Element('video', {'youtube':'1.00:'+self.youtube_id, 'youtube_id_1_0':self.youtube_id});
-		tree = ElementTree(video)
-		tree.write(os.path.join(video_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "video/{0}.xml".format(self.url_name()), video)
 
 
 	def parent_tag(self, xml):
@@ -374,52 +1366,50 @@ class ContentVideoYouTube:
 		e = SubElement(xml, 'video', {'url_name':self.url_name()})
 
 
-class ContentPdf:
+class ContentPdf(Content):
+
+	__slots__ = ('path',)
 
 	def __init__(self, parent, path):
 		logging.debug("ContentPdf:__init__ %s", path)
-		self.parent = parent
+		Content.__init__(self, parent, '_' + path)
 		self.path = path
 
-	def url_name(self):
-		return re.sub(r'\W+', '', self.parent.url_name() + '_' + self.path)
+	def inputs(self):
+		"The files and directories, relative to the group, which edx() reads."
+		return [self.path]
 
-	def edx(self, out_dir):
+	def static_files(self):
+		"The files, with their extension, which edx() stores by static_file()."
+		return [(os.path.join(self.parent.path, self.path), '.pdf')]
+
+	def edx(self, out):
+		course_url = self.parent.settings.course_url
 		# Copy the Pdf to the static directory
-		static_dir = os.path.join(out_dir, 'static')
-		if not os.path.exists(static_dir):
-			os.makedirs(static_dir)
-		# In order to get an unique filename inside edx, we have to prefix the project and group name
-		target_filename = self.url_name()+'.pdf'
-		target_path = os.path.join(static_dir,target_filename)
-		shutil.copyfile(os.path.join(self.parent.path, self.path), target_path);
+		[(path_complete, extension)] = self.static_files()
+		(url, target_filename) = self.static_file(out, path_complete, extension)
+		# The viewer needs the public URL of the Pdf.
+		viewer_url = url
+		if url.startswith('/static/'):
+			viewer_url = "{0}/asset/{1}".format(course_url, target_filename)
 
-		html_dir = os.path.join(out_dir, 'html')
-		if not os.path.exists(html_dir):
-			os.makedirs(html_dir)
 		html = Element('html', {'filename':self.url_name(), 'display_name':"Pdf"});
-		tree = ElementTree(html)
-		tree.write(os.path.join(html_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "html/{0}.xml".format(self.url_name()), html)
 
 		# We have to double %% because % is a placeholder for the argument
 		html = ''
-		if courseURL == None:
+		if course_url == None:
 			logging.warning("courseURL is not specified. Therefore the inline pdf-viewer will be disabled.")
 		else:
 			html += '''
-			<iframe src="http://docs.google.com/viewer?url=%(courseURL)s/asset/%(file)s&embedded=true"  style="border: none; width:100%%; height:780px;"></iframe>
-			''' % {'courseURL':courseURL , 'file':target_filename}
+			<iframe src="http://docs.google.com/viewer?url=%(url)s&embedded=true"  style="border: none; width:100%%; height:780px;"></iframe>
+			''' % {'url':escape(viewer_url)}
 		
 		html += '''
-		<a href="/static/%(file)s">Download Pdf %(name)s</a>
-		''' % {'file':target_filename, 'name':os.path.basename(self.path)}
-
-		with codecs.open(os.path.join(html_dir, "{0}.html".format(self.url_name())), mode='w', encoding='utf-8') as f:
-			f.write(html)
+		<a href="%(url)s" download="%(name)s">Download Pdf %(name)s</a>
+		''' % {'url':escape(url), 'name':escape(os.path.basename(self.path))}
 
-	def parent_tag(self, xml):
-		"Adds the XML element pointing to this resoure to the vertical."
-		e = SubElement(xml, 'html', {'url_name':self.url_name()})
+		write_html(out, "html/{0}.html".format(self.url_name()), html)
 
 
 # --- Part 2 -----------------------------------------------------------------
@@ -430,11 +1420,15 @@ class Project:
 	def __init__(self,project):
 		self.project = project
 		self.groups = []
+		self._url_name = URL_NAME_PATTERN.sub('', project)
 
 	def append(self, group):
-		"""Appends a group to a project and keeps the groups list sorted"""
+		"""Appends a group to a project. Call sort() once all groups are appended."""
 		self.groups.append(group)
-		self.groups = sorted(self.groups, key=operator.methodcaller('group'))
+
+	def sort(self):
+		"""Sorts the groups by their name."""
+		self.groups.sort(key=operator.methodcaller('group'))
 
 	def __len__(self):
 		return len(self.groups)
@@ -444,31 +1438,84 @@ class Project:
 
 	def url_name(self):
 		"""Just keeps the basic ASCII characters: It removes any whitespaces and umlauts."""
-		return re.sub(r'\W+', '', self.project)
+		return self._url_name
 
 	def __repr__(self):
 		return "<Project '{0}' {1}>".format(escape(self.project), repr(self.groups))
 
-	def edx(self, out_dir):
-		chapter_dir = os.path.join(out_dir, 'chapter')
-		if not os.path.exists(chapter_dir):
-			os.makedirs(chapter_dir)
+	def edx(self, out, cache=None, renderer=None, journal=None):
+		"""Writes the files of this project into the sink out. The groups are rendered by the ParallelRenderer renderer, if given,
+		and recorded by the Journal journal, if given."""
 		chapter = Element('chapter', {'display_name':escape(self.project)});
 		for group in self.groups:
 			e = SubElement(chapter, 'sequential')
 			e.set('url_name', group.url_name())
-		tree = ElementTree(chapter)
-		tree.write(os.path.join(chapter_dir, "{0}.xml".format(self.url_name())) )
+		write_xml(out, "chapter/{0}.xml".format(self.url_name()), chapter)
 
 		for group in self.groups:
-			group.edx(out_dir)
+			if renderer is None:
+				group.edx(out, cache)
+			else:
+				renderer.render(group, out)
+			if journal is not None:
+				journal.record_rendered(group)
+
+
+class Registry:
+	"""Maps the url_names of the course to what they name, to detect collisions.
+
+	url_name() strips everything but the basic ASCII characters, so different projects, groups or
+	content items may get the same url_name and the files of one would overwrite the other."""
+
+	def __init__(self):
+		self.names = {'project':{}, 'group':{}, 'content':{}}
+		self.collisions = []
+
+	def add(self, kind, url_name, key, description):
+		"""Registers url_name for the object identified by key and returns False, if it collides. Adding the same key again is fine."""
+		known = self.names[kind].setdefault(url_name, (key, description))
+		if known[0] != key:
+			self.collisions.append((kind, url_name, known[1], description))
+			return False
+		return True
+
+	def add_group(self, group):
+		"""Registers the project, the group and the content items of a loaded group."""
+		# The path is a byte string, which may not be ASCII.
+		path = group.path
+		if isinstance(path, str):
+			path = path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+		self.add('project', URL_NAME_PATTERN.sub('', group.project()), group.project(), u"'{0}'".format(group.project()))
+		if not self.add('group', group.url_name(), id(group), u"'{0}/{1}' at {2}".format(group.project(), group.group(), path)):
+			# The content items of the group collide as well, reporting the group is enough.
+			return
+		for c in group.content:
+			description = u"{0} {1} of the group at {2}".format(c.__class__.__name__, json.dumps(c.params(), sort_keys=True), path)
+			self.add('content', c.url_name(), (id(group), description), description)
+
+	def describe(self, collision):
+		"""Returns the message for a collision."""
+		(kind, url_name, first, second) = collision
+		return u"The url_name '{0}' of the {1} {2} is already used by the {1} {3}.".format(url_name, kind, second, first)
+
+	def check(self):
+		"""Reports all collisions and raises a SubprocessError, if there are any."""
+		for collision in self.collisions:
+			logging.error("%s", self.describe(collision))
+		if self.collisions:
+			raise SubprocessError("Found {0} colliding url_names. Rename the projects, groups or files.".format(len(self.collisions)))
+
+
+# The keys of the content items in group.yaml, see Group.load().
+CONTENT_KEYS = ('html', 'source', 'text', 'video', 'pdf', 'file')
 
 
 class Group:
-	"""Represents a submitted group."""
+	"""Represents a submitted group. It's rendered with the Settings settings, or the default ones."""
 
-	def __init__(self, path):
+	def __init__(self, path, settings=None):
 		self.path = path
+		self.settings = settings if settings is not None else Settings()
 		self.content = []
 
 	def load(self):
@@ -477,6 +1524,8 @@ class Group:
 		# We don't catch any exception here, because the using function should decide on what to do.
 		f = codecs.open(os.path.join(self.path, 'group.yaml'), mode='r', encoding='utf-8')
 		self.properties = yaml.safe_load(f)
+		# The content items compute their url_names from it.
+		self._url_name = URL_NAME_PATTERN.sub('', self.project() + '_' + self.group())
 
 		self.content = []
 		self.content.append(ContentIntro(self))
@@ -509,6 +1558,59 @@ class Group:
 
 		self.content.append(ContentDiscussion(self))
 
+	def check(self):
+		"""Validates the group definition without loading it and returns the lists of errors and warnings.
+
+		If there are no errors, load() succeeds and edx() finds all the referenced files."""
+		errors = []
+		warnings = []
+		try:
+			with codecs.open(os.path.join(self.path, 'group.yaml'), mode='r', encoding='utf-8') as f:
+				properties = yaml.safe_load(f)
+		except (IOError, UnicodeError, yaml.YAMLError) as exc:
+			return (["Can't read group.yaml: {0}".format(exc)], warnings)
+		if not isinstance(properties, dict):
+			return (["group.yaml doesn't define the keys project, group, authors and content."], warnings)
+
+		for key in ('project', 'group'):
+			if not isinstance(properties.get(key), basestring) or not properties[key].strip():
+				errors.append("The key '{0}' is missing or isn't a text.".format(key))
+
+		authors = properties.get('authors')
+		if not isinstance(authors, list):
+			errors.append("The key 'authors' is missing or isn't a list.")
+		else:
+			for author in authors:
+				if not isinstance(author, dict) or not all(isinstance(author.get(key), basestring) for key in ('name', 'email')):
+					errors.append("The author {0} needs a name and an email.".format(json.dumps(author)))
+
+		content = properties.get('content')
+		if not isinstance(content, list):
+			errors.append("The key 'content' is missing or isn't a list.")
+			content = []
+		for c in content:
+			if not isinstance(c, dict) or not any(key in c for key in CONTENT_KEYS):
+				warnings.append("The content {0} is ignored.".format(json.dumps(c)))
+				continue
+			for (key, value) in c.items():
+				if key not in CONTENT_KEYS:
+					continue
+				if not isinstance(value, basestring):
+					errors.append("The {0} {1} isn't a text.".format(key, json.dumps(value)))
+				elif key == 'video':
+					o = urlparse.urlparse(value)
+					if o.netloc != 'www.youtube.com' or not o.query.startswith('v=') or len(o.query) == 2:
+						errors.append("The video {0} isn't a YouTube URL like https://www.youtube.com/watch?v=ID.".format(value))
+				elif os.path.isabs(value) or os.path.normpath(value).split(os.sep)[0] == os.pardir:
+					errors.append("The {0} {1} is outside of the group.".format(key, value))
+				elif key == 'source' and not os.path.isdir(os.path.join(self.path, value)):
+					errors.append("The source directory {0} doesn't exist.".format(value))
+				elif key != 'source' and not os.path.isfile(os.path.join(self.path, value)):
+					errors.append("The {0} file {1} doesn't exist.".format(key, value))
+				elif key in ('pdf', 'file') and self.settings.static_file_limit is not None and self.settings.asset_url is None and os.path.getsize(os.path.join(self.path, value)) > self.settings.static_file_limit:
+					errors.append("The {0} {1} is larger than --max-static-file-size.".format(key, value))
+		return (errors, warnings)
+
 	def project(self):
 		return self.properties['project']
 
@@ -519,36 +1621,120 @@ class Group:
 		return self.properties['authors']
 
 	def url_name(self):
-		"""Just keeps the basic ASCII characters: It removes any whitespaces and umlauts."""
-		return re.sub(r'\W+', '', self.project() + '_' + self.group() )
+		"""Just keeps the basic ASCII characters: It removes any whitespaces and umlauts. Computed by load()."""
+		return self._url_name
 
 	def __repr__(self):
 		return "<Group '{0}/{1}'>".format(escape(self.project()), escape(self.group()))
 
-	def edx(self, out_dir):
-		sequential_dir = os.path.join(out_dir, 'sequential')
-		if not os.path.exists(sequential_dir):
-			os.makedirs(sequential_dir)
-		sequential = Element('sequential', {'display_name':escape(self.group())});
-		e = SubElement(sequential, 'vertical')
-		e.set('url_name', self.url_name()+'_vertical')
-		tree = ElementTree(sequential)
-		tree.write(os.path.join(sequential_dir, "{0}.xml".format(self.url_name())) )
+	def edx(self, out, cache=None):
+		"""Writes the files of this group into the sink out. The content items are taken from the RenderCache cache, if given."""
+		with span(u'{0}/{1}'.format(self.project(), self.group()), 'group', out, path=self.path):
+			sequential = Element('sequential', {'display_name':escape(self.group())});
+			e = SubElement(sequential, 'vertical')
+			e.set('url_name', self.url_name()+'_vertical')
+			write_xml(out, "sequential/{0}.xml".format(self.url_name()), sequential)
+
+			vertical = Element('vertical', {'display_name':'MainUnit'});
+
+			for c in self.content:
+				c.parent_tag(vertical)
+			if cache is None:
+				for c in self.content:
+					with span(c.url_name(), 'content', out, type=c.__class__.__name__):
+						c.edx(out)
+			else:
+				cache.render_group(self, out)
 
-		vertical_dir = os.path.join(out_dir, 'vertical')
-		if not os.path.exists(vertical_dir):
-			os.makedirs(vertical_dir)
-		vertical = Element('vertical', {'display_name':'MainUnit'});
+			write_xml(out, "vertical/{0}.xml".format(self.url_name()+'_vertical'), vertical)
 
-		for c in self.content:
-			c.parent_tag(vertical)
-			c.edx(out_dir)
 
-		tree = ElementTree(vertical)
-		tree.write(os.path.join(vertical_dir, "{0}.xml".format(self.url_name()+'_vertical')) )
+# --- Part 3 -----------------------------------------------------------------
 
 
-# --- Part 3 -----------------------------------------------------------------
+# Limits for the extraction of remote archives, which are not under our control.
+MAX_ARCHIVE_SIZE = 1024 * 1024 * 1024
+MAX_ARCHIVE_MEMBERS = 10000
+
+# An interrupted download is resumed at most DOWNLOAD_RESUMES times. Its progress is logged every DOWNLOAD_PROGRESS_INTERVAL seconds.
+DOWNLOAD_RESUMES = 5
+DOWNLOAD_PROGRESS_INTERVAL = 5
+# The seconds to wait for the connection and for each block of a download. A stalled transfer is resumed afterwards.
+DOWNLOAD_TIMEOUT = (10, 60)
+# The connections kept open to each host, enough for the usual --jobs.
+HTTP_POOL_SIZE = 16
+
+
+# The RenderCache of a worker process of a ParallelRenderer.
+_worker_cache = None
+
+def _render_worker_init(cache):
+	global _worker_cache
+	_worker_cache = cache
+	# The spans of the main process are inherited by fork, the worker only reports its own.
+	if profiler is not None:
+		profiler.take()
+
+def _render_worker(task):
+	"""Renders a group into its staging directory inside a worker process."""
+	(group, staging_dir) = task
+	out = StagingSink(staging_dir)
+	sink = out
+	if group.settings.write_queue_limit > 0:
+		sink = WriteBehindSink(sink, group.settings.write_queue_limit)
+	if profiler is not None:
+		sink = CountingSink(sink)
+	try:
+		group.edx(sink, _worker_cache)
+	finally:
+		sink.close()
+	results = None
+	if _worker_cache is not None:
+		results = _worker_cache.results()
+	events = None
+	if profiler is not None:
+		events = profiler.take()
+	return (group.url_name(), staging_dir, out.names, results, events)
+
+
+class ParallelRenderer:
+	"""Renders the groups in worker processes.
+
+	Each worker writes a group into its own staging directory. Project.edx() calls render() for
+	each group in the serial order, which moves the staged files into the sink. Therefore the
+	output doesn't depend on the scheduling and is identical to a serial run."""
+
+	def __init__(self, projects, processes, staging_dir, cache=None):
+		self.cache = cache
+		self.staging_dir = staging_dir
+		tasks = []
+		for project in projects:
+			for group in project.groups:
+				tasks.append((group, os.path.join(staging_dir, str(len(tasks)))))
+		self.pool = multiprocessing.Pool(processes, _render_worker_init, (cache,))
+		self.results = self.pool.imap(_render_worker, tasks)
+
+	def render(self, group, out):
+		# next() with a timeout keeps the main process responsive to Ctrl-C.
+		(url_name, staging_dir, names, results, events) = self.results.next(sys.maxint)
+		assert url_name == group.url_name(), "The groups are rendered out of order."
+		for name in names:
+			out.move(name, os.path.join(staging_dir, *name.split('/')))
+		shutil.rmtree(staging_dir)
+		if results is not None:
+			self.cache.merge(results)
+		if events is not None:
+			profiler.merge(events)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		if os.path.exists(self.staging_dir):
+			shutil.rmtree(self.staging_dir)
+
+	def terminate(self):
+		self.pool.terminate()
+		self.pool.join()
 
 
 # This customized LoggingFormatter formats all the output of this tool.
@@ -567,16 +1753,1089 @@ class LoggingFormatter(logging.Formatter):
 
 class SubprocessError(Exception):
 	def __init__(self, message):
+		# The arguments are passed on, so the error can be pickled by the worker processes of --processes.
+		Exception.__init__(self, message)
 		self.message = message
 
 	def __str__(self):
 		return self.message
 
 
-def main():
+class ArchiveError(SubprocessError):
+	"""An archive is refused. Unlike a failed download, this doesn't change when it's tried again."""
+	pass
 
-	# The following block parses the arguments supplied.
+
+def ensure_dir(path):
+	"""Creates the directory path unless it exists. Safe to be called concurrently."""
+	try:
+		os.makedirs(path)
+	except OSError as exc:
+		if exc.errno != errno.EEXIST: # Another thread was faster.
+			raise
+
+
+# The locks of cache_lock() by path, for the threads of this process.
+_cache_locks = {}
+_cache_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def cache_lock(path):
+	"""Holds an exclusive lock of the lock file path while the enclosed block runs.
+
+	The threads of this process are always serialized, concurrent runs only where fcntl is available."""
+	with _cache_locks_lock:
+		lock = _cache_locks.setdefault(path, threading.Lock())
+	with lock:
+		with open(path, 'w') as f:
+			if fcntl is not None:
+				fcntl.flock(f, fcntl.LOCK_EX)
+			yield
+
+
+def run_git(args, subprocess_setting, error_message):
+	"""Runs a GIT command and raises a SubprocessError with error_message if it fails."""
+	try:
+		p = subprocess.Popen(['git'] + args, **subprocess_setting)
+		p.communicate()
+		if p.returncode != 0:
+			logging.error(error_message)
+			raise SubprocessError(error_message)
+
+	except OSError:
+		logging.error("GIT not found. Do you have GIT installed?")
+		raise
+
+
+def checkout_mirror(source, path, cache_dir, subprocess_setting):
+	"""Checks out the GIT repository source into path using a bare mirror inside cache_dir.
+
+	The mirror is keyed by the URL of the repository. The first run clones it, later runs
+	just fetch the new commits. The checkout is a detached worktree of the mirror."""
+
+	mirrors_dir = os.path.join(cache_dir, 'git')
+	ensure_dir(mirrors_dir)
+	key = hashlib.sha1(source).hexdigest()
+	mirror = os.path.join(mirrors_dir, key + '.git')
+
+	# The lock serializes the access to the mirror across threads and concurrent runs.
+	with cache_lock(os.path.join(mirrors_dir, key + '.lock')):
+
+		if os.path.exists(mirror):
+			logging.warning("Fetching %s", source)
+			run_git(['--git-dir', mirror, 'fetch', '--prune', 'origin'], subprocess_setting, "Failed to fetch GIT repository {0}".format(source))
+		else:
+			logging.warning("Cloning %s", source)
+			# We clone next to the final location, so an interrupted clone never looks like a valid mirror.
+			partial = mirror + '.partial'
+			if os.path.exists(partial):
+				shutil.rmtree(partial)
+			run_git(['clone', '--mirror', source, partial], subprocess_setting, "Failed to clone GIT repository {0}".format(source))
+			os.rename(partial, mirror)
+
+		# Worktrees of previous runs are gone with their temporary directory.
+		run_git(['--git-dir', mirror, 'worktree', 'prune'], subprocess_setting, "Failed to prune the worktrees of {0}".format(mirror))
+		run_git(['--git-dir', mirror, 'worktree', 'add', '--detach', path, 'HEAD'], subprocess_setting, "Failed to check out GIT repository {0}".format(source))
+
+
+# The requests session of each process, see http_session().
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def http_session():
+	"""Returns the requests session shared by the downloads of this process.
+
+	The session keeps the connections to each host open, so the following sources from the same host
+	don't connect again. A forked process gets a session of its own instead of the connections of its parent."""
+
+	# main() has already checked that requests is available.
+	import requests
+
+	with _http_sessions_lock:
+		session = _http_sessions.get(os.getpid())
+		if session is None:
+			session = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+			session.mount('http://', adapter)
+			session.mount('https://', adapter)
+			_http_sessions[os.getpid()] = session
+	return session
+
+
+def download(source, path, headers=None):
+	"""Downloads the URL source to path and returns the last response and the SHA-256 digest of the file.
+
+	An interrupted transfer is resumed with a HTTP Range request. The ETag or Last-Modified header of the
+	response is kept in path.validator until the download is complete, so a later call resumes the
+	file left at path as well, unless the remote file changed meanwhile. The conditional headers are
+	only sent with a new download. If they yield a '304 Not Modified', the digest is None and path is untouched."""
+
+	import requests
+
+	session = http_session()
+	validator_path = path + '.validator'
+	validator = None
+	offset = 0
+	digest = hashlib.sha256()
+	if os.path.exists(path) and os.path.exists(validator_path):
+		with open(validator_path, 'r') as f:
+			validator = f.read()
+		with open(path, 'rb') as f:
+			for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+				digest.update(block)
+				offset += len(block)
+
+	resumes = 0
+	while True:
+		if offset > 0:
+			logging.info("Resuming the download of %s after %d bytes.", source, offset)
+			response = session.get(source, stream=True, headers={'Range':'bytes={0}-'.format(offset), 'If-Range':validator}, timeout=DOWNLOAD_TIMEOUT)
+			if response.status_code == 416:
+				# The kept part is no prefix of the remote file.
+				response.close()
+				offset = 0
+				digest = hashlib.sha256()
+				continue
+		else:
+			response = session.get(source, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+			if response.status_code == 304:
+				response.close()
+				return (response, None)
+		# Raise in case of server/network problems: (4xx, 5xx, ...)
+		response.raise_for_status()
+
+		if response.status_code != 206 and offset > 0:
+			logging.info("The server sent %s again from the start.", source)
+			offset = 0
+			digest = hashlib.sha256()
+		if offset == 0:
+			validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+			if validator is not None:
+				with open(validator_path, 'w') as f:
+					f.write(validator)
+			elif os.path.exists(validator_path):
+				os.remove(validator_path)
+
+		total = None
+		if 'Content-Length' in response.headers:
+			total = offset + int(response.headers['Content-Length'])
+		start = time.time()
+		received = 0
+		reported = start
+		error = None
+		try:
+			with open(path, 'ab' if offset > 0 else 'wb') as handle:
+				for block in response.iter_content(COPY_BUFFER_SIZE):
+					handle.write(block)
+					digest.update(block)
+					offset += len(block)
+					received += len(block)
+					now = time.time()
+					if now - reported >= DOWNLOAD_PROGRESS_INTERVAL:
+						reported = now
+						logging.info("Downloaded %.1f of %s MB of %s (%.1f MB/s).", offset / 1048576.0,
+						             "?" if total is None else "{0:.1f}".format(total / 1048576.0), source, received / 1048576.0 / (now - start))
+		except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as exc:
+			error = exc
+		finally:
+			response.close()
+
+		if error is None and (total is None or offset >= total):
+			break
+		if validator is None or resumes == DOWNLOAD_RESUMES:
+			raise SubprocessError("The download of {0} was interrupted after {1} bytes: {2}".format(source, offset, error or "incomplete response"))
+		resumes += 1
+		logging.warning("The download of %s was interrupted after %d bytes: %s", source, offset, error or "incomplete response")
+
+	if os.path.exists(validator_path):
+		os.remove(validator_path)
+	duration = max(time.time() - start, 0.001)
+	logging.info("Downloaded %s, %.1f MB (%.1f MB/s).", source, offset / 1048576.0, received / 1048576.0 / duration)
+	return (response, digest.hexdigest())
+
+
+def download_archive(source, archive_path):
+	"""Downloads the remote archive source to archive_path."""
+	logging.info("Downloading remote archive to %s.", archive_path);
+	download(source, archive_path)
+
+
+def download_cached_archive(source, cache_dir):
+	"""Downloads the remote archive source into cache_dir, unless the cached copy is still valid.
+
+	Archives are stored under the SHA-256 digest of their content. For each URL we remember the digest
+	together with the ETag and Last-Modified headers of the response. They are sent back as a conditional
+	request, so an unchanged archive costs a '304 Not Modified' instead of a full transfer.
+	An interrupted download is resumed by the next run.
+	Returns the path of the cached archive and its digest."""
+
+	downloads_dir = os.path.join(cache_dir, 'downloads')
+	ensure_dir(downloads_dir)
+	key = hashlib.sha1(source).hexdigest()
+	meta_path = os.path.join(downloads_dir, key + '.json')
+	extension = '.zip' if urlparse.urlparse(source).path.endswith('.zip') else '.tar.gz'
+
+	# The lock serializes the access to the entry of this URL across threads and concurrent runs.
+	with cache_lock(os.path.join(downloads_dir, key + '.lock')):
+
+		meta = None
+		if os.path.exists(meta_path):
+			with open(meta_path, 'r') as f:
+				meta = json.load(f)
+			if not os.path.exists(os.path.join(downloads_dir, meta['digest'] + extension)):
+				meta = None
+
+		headers = {}
+		if meta is not None:
+			if meta.get('etag'):
+				headers['If-None-Match'] = meta['etag']
+			if meta.get('last_modified'):
+				headers['If-Modified-Since'] = meta['last_modified']
+
+		logging.info("Downloading remote archive %s.", source)
+		partial = os.path.join(downloads_dir, key + '.partial')
+		(request, digest) = download(source, partial, headers)
+		if digest is None:
+			logging.info("Remote archive %s is unchanged.", source)
+			return (os.path.join(downloads_dir, meta['digest'] + extension), meta['digest'])
+		archive_path = os.path.join(downloads_dir, digest + extension)
+		os.rename(partial, archive_path)
+
+		meta = {'url':source, 'digest':digest, 'etag':request.headers.get('ETag'), 'last_modified':request.headers.get('Last-Modified')}
+		with open(meta_path + '.partial', 'w') as f:
+			json.dump(meta, f)
+		os.rename(meta_path + '.partial', meta_path)
+
+	return (archive_path, digest)
+
+
+def archive_members(archive_path):
+	"""Lists the members of a .zip or .tar.gz archive.
+
+	Returns the opened archive and a list of (name, size, is_file, member) in archive order."""
+
+	if archive_path.endswith('.zip'):
+		archive = zipfile.ZipFile(archive_path)
+		members = []
+		for info in archive.infolist():
+			# Symbolic links are marked in the unix mode of the external attributes.
+			is_link = stat.S_ISLNK(info.external_attr >> 16)
+			members.append((info.filename, info.file_size, not info.filename.endswith('/') and not is_link, info))
+	else:
+		archive = tarfile.open(archive_path, 'r:gz')
+		members = [(info.name, info.size, info.isfile(), info) for info in archive.getmembers()]
+	return (archive, members)
+
+
+def extract_archive(source, archive_path, local_path, max_size=MAX_ARCHIVE_SIZE, max_members=MAX_ARCHIVE_MEMBERS):
+	"""Extracts the directory of the archive containing 'group.yaml' into local_path.
+
+	The members are streamed straight to disk. Only regular files below the directory of the
+	shallowest 'group.yaml' are extracted. Archives with more than max_members members, members
+	with absolute or parent ('..') paths, or more than max_size extracted bytes are refused."""
+
+	logging.info("Extracting %s", source)
+	(archive, members) = archive_members(archive_path)
+	try:
+		if len(members) > max_members:
+			raise ArchiveError("The archive {0} has more than {1} members.".format(source, max_members))
+
+		# We search for a file called group.yaml, which gives us the directory to process
+		prefix = None
+		for (name, size, is_file, member) in members:
+			parts = name.split('/')
+			if name.startswith('/') or '..' in parts:
+				raise ArchiveError("The archive {0} contains the unsafe path {1}.".format(source, name))
+			if is_file and parts[-1] == 'group.yaml':
+				directory = name[:-len('group.yaml')]
+				if prefix is None or directory.count('/') < prefix.count('/'):
+					prefix = directory
+		if prefix is None:
+			logging.error("No group.yaml file found in %s", source)
+			raise ArchiveError("No group.yaml file found in {0}".format(source))
+		logging.debug("Found a group.yaml file inside %s.", prefix or '/')
+
+		extracted = 0
+		for (name, size, is_file, member) in members:
+			if not is_file or not name.startswith(prefix):
+				continue
+			target = os.path.join(local_path, *name[len(prefix):].split('/'))
+			ensure_dir(os.path.dirname(target))
+			if isinstance(archive, zipfile.ZipFile):
+				src = archive.open(member)
+			else:
+				src = archive.extractfile(member)
+			try:
+				with open(target, 'wb') as dst:
+					while True:
+						block = src.read(64 * 1024)
+						if not block:
+							break
+						# We count the bytes actually written, not the sizes the archive claims.
+						extracted += len(block)
+						if extracted > max_size:
+							raise ArchiveError("The archive {0} extracts to more than {1} bytes.".format(source, max_size))
+						dst.write(block)
+			finally:
+				src.close()
+	finally:
+		archive.close()
+
+
+def acquire_source(source, tmp_dir, subprocess_setting, cache_dir=None, archive_limits=(MAX_ARCHIVE_SIZE, MAX_ARCHIVE_MEMBERS)):
+	"""Makes a source available locally and returns the directory containing its 'group.yaml'.
+
+	Remote sources are downloaded or cloned into a 'unique' directory inside tmp_dir, so this
+	function may be called for several sources concurrently. If cache_dir is given, GIT
+	repositories are mirrored there and only updated on later runs. Remote archives are cached
+	there as well, together with their extracted content. archive_limits are the maximal size and
+	number of members of an extracted archive."""
+
+	if os.path.exists(source):
+		return source
+
+	if source.endswith(('zip', 'tar.gz')):
+		logging.info("Assuming that %s is a remote archive.", source)
+
+		if cache_dir is not None:
+			(archive_path, digest) = download_cached_archive(source, cache_dir)
+
+			# The extracted tree is keyed by the digest of the archive and only read afterwards.
+			local_path = os.path.join(cache_dir, 'extracted', digest)
+			if os.path.exists(local_path):
+				logging.info("Using the extracted archive %s.", local_path)
+			else:
+				partial = os.path.join(cache_dir, 'extracted', str(uuid.uuid4()) + '.partial')
+				os.makedirs(partial)
+				extract_archive(source, archive_path, partial, *archive_limits)
+				try:
+					os.rename(partial, local_path)
+				except OSError:
+					# The same archive was extracted concurrently.
+					shutil.rmtree(partial)
+		else:
+			# We need a 'unique' directory for the local checkout
+			dest = str(uuid.uuid4())
+			local_path = os.path.join(tmp_dir, dest)
+			os.makedirs(local_path)
+
+			# Wen need the file-extension of the remote file
+			o = urlparse.urlparse(source)
+			(_ , filename_compressed) = os.path.split(o.path)
+			archive_path = os.path.join(local_path, filename_compressed)
+			download_archive(source, archive_path)
+			local_path = os.path.join(local_path, 'group')
+			os.makedirs(local_path)
+			extract_archive(source, archive_path, local_path, *archive_limits)
+
+		path = local_path
+
+	else:
+		logging.info("There is no directory %s. Assuming that it's a remote GIT repository.", source)
+		# We need a 'unique' directory for the local checkout
+		dest = str(uuid.uuid4())
+		path = os.path.join(tmp_dir, dest)
+
+		if cache_dir is not None:
+			checkout_mirror(source, path, cache_dir, subprocess_setting)
+		else:
+			logging.warning("Cloning %s", source)
+			run_git(['clone', source, path], subprocess_setting, "Failed to clone GIT repository {0}".format(source))
+
+	return path
+
+
+class Journal:
+	"""Records the acquired sources and the rendered groups of a build in the work directory.
+
+	The journal is a file of JSON lines, which are appended while the build proceeds, so it survives
+	a crash. With --resume, the next run reuses the remote sources acquired by the previous runs.
+	The RenderCache keeps the files of the rendered groups, the journal only counts them."""
+
+	def __init__(self, path, resume=False):
+		self.path = path
+		self.acquired = {}
+		self.rendered = set()
+		if resume and os.path.exists(path):
+			with open(path, 'r') as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						# The last line may be incomplete after a crash.
+						continue
+					if entry['event'] == 'acquired':
+						self.acquired[entry['source']] = entry['path']
+					elif entry['event'] == 'rendered':
+						self.rendered.add(entry['url_name'])
+		self.lock = threading.Lock()
+		self.file = open(path, 'a' if resume else 'w')
+
+	def _append(self, entry):
+		entry['time'] = time.time()
+		with self.lock:
+			self.file.write(json.dumps(entry) + '\n')
+			self.file.flush()
+
+	def acquired_path(self, source):
+		"""Returns the local path of the source, if a previous run acquired it and it's still there."""
+		path = self.acquired.get(source)
+		if path is not None and os.path.exists(os.path.join(path, 'group.yaml')):
+			return path
+		return None
+
+	def record_acquired(self, source, path):
+		# The paths stay valid, if the next run is started from another working directory.
+		self._append({'event':'acquired', 'source':source, 'path':os.path.abspath(path)})
+
+	def record_rendered(self, group):
+		self._append({'event':'rendered', 'path':os.path.abspath(group.path), 'url_name':group.url_name()})
+
+	def close(self):
+		self.file.close()
+
+
+def map_pool(function, items, pool):
+	"""Returns map(function, items) computed by the threads or processes of pool, which is closed afterwards."""
+	try:
+		# map_async().get() with a timeout keeps the main thread responsive to Ctrl-C, map() would block it.
+		return pool.map_async(function, items).get(sys.maxint)
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.close()
+		pool.join()
+
+
+def map_sources(function, sources, jobs=1):
+	"""Returns map(function, sources) computed by up to 'jobs' threads."""
+	if jobs > 1:
+		return map_pool(function, sources, ThreadPool(jobs))
+	return map(function, sources)
+
+
+def acquire_sources(sources, tmp_dir, subprocess_setting, jobs=1, cache_dir=None, archive_limits=(MAX_ARCHIVE_SIZE, MAX_ARCHIVE_MEMBERS), journal=None, retries=0, retry_delay=1):
+	"""Acquires all sources, using up to 'jobs' threads, and returns their local paths in the order of the sources.
+
+	The sources are independent of each other, so a failing source doesn't stop the others.
+	A failing source is tried again up to 'retries' times, waiting retry_delay seconds and twice as
+	long after each further failure. The sources recorded by the Journal journal are reused, the
+	newly acquired ones are recorded. All failures are reported at the end by raising a SubprocessError."""
+
+	def fetch(source):
+		# Local sources are used as they are, a relative one may point elsewhere in this run.
+		if journal is not None and not os.path.exists(source):
+			path = journal.acquired_path(source)
+			if path is not None:
+				logging.info("Reusing %s for %s from the journal.", path, source)
+				return (path, None)
+		for attempt in range(retries + 1):
+			try:
+				with span(source, 'source'):
+					path = acquire_source(source, tmp_dir, subprocess_setting, cache_dir, archive_limits)
+				break
+			except ArchiveError as exc:
+				return (None, exc)
+			except Exception as exc:
+				if attempt == retries:
+					return (None, exc)
+				delay = retry_delay * 2 ** attempt
+				logging.warning("Failed to acquire %s, trying again in %s seconds: %s", source, delay, exc)
+				time.sleep(delay)
+		if journal is not None:
+			journal.record_acquired(source, path)
+		return (path, None)
+
+	results = map_sources(fetch, sources, jobs)
+
+	failures = [(source, exc) for source, (_, exc) in zip(sources, results) if exc is not None]
+	if failures:
+		for source, exc in failures:
+			logging.error("Failed to acquire %s: %s", source, exc)
+		raise SubprocessError("Failed to acquire {0} of {1} sources.".format(len(failures), len(sources)))
+
+	return [path for (path, _) in results]
+
+
+def load_group(path, settings=None):
+	"""Loads the group definition at path, which is rendered with the Settings settings."""
+	logging.info("Processing %s", path)
+	g = Group(path, settings)
+	with span(path, 'load'):
+		g.load()
+	return g
+
+
+def check_sources(sources, tmp_dir, subprocess_setting, jobs=1, cache_dir=None, archive_limits=(MAX_ARCHIVE_SIZE, MAX_ARCHIVE_MEMBERS), settings=None):
+	"""Acquires and validates the sources without rendering them and returns a report for each source, see --check.
+
+	The sources are checked by up to 'jobs' threads. The url_names of all sources are compared afterwards."""
+
+	def check(source):
+		report = {'source':source, 'path':None, 'project':None, 'group':None, 'errors':[], 'warnings':[]}
+		group = None
+		try:
+			with span(source, 'source'):
+				report['path'] = acquire_source(source, tmp_dir, subprocess_setting, cache_dir, archive_limits)
+			group = Group(report['path'], settings)
+			with span(report['path'], 'load'):
+				(report['errors'], report['warnings']) = group.check()
+				if not report['errors']:
+					group.load()
+					report['project'] = group.project()
+					report['group'] = group.group()
+		except Exception as exc:
+			report['errors'].append(str(exc))
+		if report['errors']:
+			group = None
+		return (report, group)
+
+	results = map_sources(check, sources, jobs)
+
+	# The collisions are reported for the source which comes later.
+	registry = Registry()
+	for (report, group) in results:
+		if group is not None:
+			known = len(registry.collisions)
+			registry.add_group(group)
+			report['errors'].extend(registry.describe(collision) for collision in registry.collisions[known:])
+	reports = [report for (report, _) in results]
+	for report in reports:
+		report['ok'] = not report['errors']
+	return reports
+
+
+def read_sources_file(path):
+	"""Returns the sources listed in the file path, one per line. Empty lines and lines starting with # are skipped."""
+	sources = []
+	with codecs.open(path, mode='r', encoding='utf-8') as f:
+		for line in f:
+			line = line.strip()
+			if line and not line.startswith('#'):
+				sources.append(line)
+	return sources
+
+
+def load_projects(paths, settings=None):
+	"""Loads the groups at paths, rendered with the Settings settings, and returns their projects, sorted by name."""
+	return collect_projects([load_group(path, settings) for path in paths])
+
+
+def collect_projects(groups):
+	"""Returns the projects of the loaded groups, sorted by name."""
+	# The strategy is as follows:
+	# projects is a dictionary with the project name as the key and a list of groups as values.
+	# When all groups are loaded, we transform the dict into a tuple, sort it and sort all the groups inside each project.
+	projects = {}
+	registry = Registry()
+	for g in groups:
+		# We add the group to the corresponding project.
+		registry.add_group(g)
+		if g.project() not in projects:
+			projects[g.project()] = Project(g.project())
+		projects[g.project()].append(g)
+
+	# Nothing is written yet, if two url_names collide.
+	registry.check()
+
+	# Sort the projects alphabetically
+	projects = projects.values()
+	list.sort(projects, key=operator.attrgetter('project'))
+	for project in projects:
+		project.sort()
+	return projects
+
+
+def write_course(out, projects, cache=None, renderer=None, journal=None, part=None):
+	"""Writes the course with the given projects into the sink out.
+
+	The shards of build_shards() are separate courses, numbered by part."""
+	# Create course.xml
+	course = Element('course');
+	course.set('url_name', 'url_name')
+	course.set('org', 'org')
+	course.set('course', 'course' if part is None else 'course-{0}'.format(part))
+	write_xml(out, "course.xml", course)
+
+	# Create course/course.xml
+	course = Element('course');
+	course.set('display_name', 'display_name' if part is None else 'display_name {0}'.format(part))
+	for project in projects:
+		e = SubElement(course, 'chapter')
+		e.set('url_name', project.url_name())
+	write_xml(out, "course/{0}.xml".format('url_name'), course)
+
+	# Let each project and implicitly each group create it's files
+	for project in projects:
+		with span(project.project, 'project', out):
+			project.edx(out, cache, renderer, journal)
+
+
+def build_course(projects, options, settings, tmp_dir, cache=None, journal=None, fileobj=None, part=None):
+	"""Writes the course of the projects into the archive options.output, see main() for the options and Settings for settings.
+
+	The content items are taken from the RenderCache cache, if given. The rendered groups are recorded by the Journal journal, if given.
+	If fileobj is given, the archive is streamed into it instead of options.output. part numbers a shard, see write_course()."""
+
+	# The archive replaces options.output once it is complete, so --watch never leaves a partial archive behind.
+	partial = None
+	if fileobj is None:
+		partial = options.output + '.partial'
+
+	# Without --tmp, the files are streamed directly into the archive.
+	# With --tmp, the edx directory is kept inside it for debugging and compressed afterwards.
+	if options.tmp is None:
+		if fileobj is None:
+			logging.info("Creating the archive %s", options.output)
+		out = TarSink(partial, 'display_name', options.compression_level, options.gzip_threads, fileobj)
+	else:
+		# Setup the edx directory structure 
+		# All the other files and directories inside are uuid named. We don't have to fear a name clash.
+		out_dir = os.path.join(tmp_dir, 'display_name')
+		# Delete the output directory, if it already exists
+		if os.path.exists(out_dir):
+			shutil.rmtree(out_dir)
+		os.makedirs(out_dir)
+		out = DirectorySink(out_dir)
+	writer = None
+	if settings.write_queue_limit > 0:
+		out = writer = WriteBehindSink(out, settings.write_queue_limit)
+	if profiler is not None:
+		out = CountingSink(out)
+
+	try:
+		# With --processes, the groups are rendered in parallel.
+		renderer = None
+		if options.processes > 1:
+			renderer = ParallelRenderer(projects, options.processes, os.path.join(tmp_dir, 'staging'), cache)
+
+		try:
+			with span('render', 'stage', out):
+				write_course(out, projects, cache, renderer, journal, part)
+		except:
+			if renderer is not None:
+				renderer.terminate()
+			raise
+		if renderer is not None:
+			renderer.close()
+
+		# Errors of the background writer are raised here, while the incomplete archive is still removed.
+		if writer is not None:
+			writer.flush()
+
+		if cache is not None:
+			cache.save()
+	except:
+		# We don't leave an incomplete archive behind. Closing the sink raises the error of
+		# the background writer again, which must neither keep us from removing the archive nor replace the original error.
+		exc_info = sys.exc_info()
+		try:
+			out.close()
+		except Exception:
+			pass
+		if partial is not None and os.path.exists(partial):
+			os.remove(partial)
+		raise exc_info[0], exc_info[1], exc_info[2]
+	with span('archive', 'stage'):
+		out.close()
+
+		if options.tmp is not None:
+			# Archive the directory to the output file
+			if fileobj is None:
+				logging.info("Creating the archive %s", options.output)
+			tar = open_archive(partial, options.compression_level, options.gzip_threads, fileobj)
+			tar.add(out_dir, arcname=os.path.basename(out_dir))
+			tar.close()
+	if partial is not None:
+		os.rename(partial, options.output)
+
+
+def estimate_size(project):
+	"""Returns the number of bytes of all the files the content items of the project read."""
+	size = 0
+	for group in project.groups:
+		for c in group.content:
+			for path in c.inputs():
+				path = os.path.join(group.path, path)
+				if os.path.isdir(path):
+					size += sum(os.path.getsize(p) for p in walk_tree(path) if os.path.isfile(p))
+				else:
+					size += os.path.getsize(path)
+	return size
+
+
+def plan_shards(projects, budget):
+	"""Splits the projects into shards of at most budget bytes, keeping the order of the projects.
+
+	Returns a list of the projects and the estimated size of each shard. A project larger than the budget gets a shard of its own."""
+	shards = []
+	for project in projects:
+		size = estimate_size(project)
+		if size > budget:
+			logging.warning("The project %s has about %d MB and exceeds the size of a shard.", project.project, size / (1024 * 1024))
+		if not shards or shards[-1][1] + size > budget:
+			shards.append(([], 0))
+		shards[-1] = (shards[-1][0] + [project], shards[-1][1] + size)
+	return shards
+
+
+def shard_path(output, suffix, extension=None):
+	"""Returns the name of the archive output with the suffix, e.g. to_import-2.tar.gz. The extension of output may be replaced."""
+	base = output
+	for archive_extension in ('.tar.gz', '.tgz', '.tar'):
+		if output.endswith(archive_extension):
+			base = output[:-len(archive_extension)]
+			if extension is None:
+				extension = archive_extension
+			break
+	return "{0}-{1}{2}".format(base, suffix, extension or '')
+
+
+def _build_shard(task):
+	"""Writes a shard inside a worker process of build_shards()."""
+	(projects, options, settings, tmp_dir, part) = task
+	build_course(projects, options, settings, tmp_dir, part=part)
+	return os.path.getsize(options.output)
+
+
+def build_shards(projects, options, settings, tmp_dir):
+	"""Writes the projects into several archives of at most --shard-size megabytes, each one a course of its own.
+
+	Each shard has its own course number, course-1, course-2 and so on, so edX imports them as separate courses.
+	Importing a shard into the course of another one would replace its content.
+
+	The shards are written in parallel by --processes processes, or one process per CPU without it.
+	The assignment of the projects and groups to the shards is printed and written to a JSON file next to the shards."""
+	budget = options.shard_size * 1024 * 1024
+	shards = plan_shards(projects, budget)
+
+	tasks = []
+	for (index, (shard_projects, _)) in enumerate(shards, 1):
+		shard_options = copy.copy(options)
+		shard_options.output = shard_path(options.output, index)
+		shard_options.processes = 1
+		shard_dir = os.path.join(tmp_dir, 'shards', str(index))
+		ensure_dir(shard_dir)
+		tasks.append((shard_projects, shard_options, settings, shard_dir, index))
+
+	processes = options.processes if options.processes > 1 else multiprocessing.cpu_count()
+	processes = min(processes, len(tasks))
+	if processes > 1:
+		sizes = map_pool(_build_shard, tasks, multiprocessing.Pool(processes))
+	else:
+		sizes = map(_build_shard, tasks)
+
+	summary = []
+	for ((shard_projects, estimate), (_, shard_options, _, _, index), size) in zip(shards, tasks, sizes):
+		summary.append({
+			'path':shard_options.output,
+			'course':'course-{0}'.format(index),
+			'bytes':size,
+			'estimated_bytes':estimate,
+			'projects':[project.project for project in shard_projects],
+			'groups':[u'{0}/{1}'.format(group.project(), group.group()) for project in shard_projects for group in project.groups],
+		})
+		print "%(path)s: %(size).1f MB, %(groups)d groups of the projects %(projects)s" % {'path':shard_options.output, 'size':size / (1024.0 * 1024), 'groups':len(summary[-1]['groups']), 'projects':', '.join(summary[-1]['projects']).encode('ascii', 'replace')}
+		if size > budget:
+			logging.warning("The shard %s exceeds --shard-size.", shard_options.output)
+	with open(shard_path(options.output, 'shards', '.json'), 'w') as f:
+		json.dump(summary, f, indent=2)
+	return summary
+
+
+def tree_state(path):
+	"""Returns the names, sizes and modification times of all the files below the directory path."""
+	state = []
+	for dirname, dirnames, filenames in os.walk(path):
+		if '.git' in dirnames:
+			dirnames.remove('.git')
+		for filename in filenames:
+			try:
+				st = os.lstat(os.path.join(dirname, filename))
+			except OSError:
+				# The file was deleted in the meantime.
+				continue
+			state.append((os.path.join(dirname, filename), st.st_size, st.st_mtime))
+	state.sort()
+	return state
+
+
+def watch(sources, paths, projects, options, settings, tmp_dir, cache):
+	"""Polls the local sources and rebuilds the course whenever one of their files changes, until Ctrl-C is pressed.
+
+	The groups stay loaded, only the changed groups are loaded again. The content items are taken
+	from the RenderCache cache, so only the items whose inputs changed are rendered again."""
+	groups = dict((g.path, g) for project in projects for g in project.groups)
+	# Remote sources are acquired once, only local directories are watched.
+	watched = [path for (source, path) in zip(sources, paths) if source == path]
+	if len(watched) < len(paths):
+		logging.warning("Only the local directories are watched, not the %d remote sources.", len(paths) - len(watched))
+	states = dict((path, tree_state(path)) for path in watched)
+
+	print "Watching %(count)d groups for changes. Press Ctrl-C to stop." % {'count':len(watched)}
+	try:
+		while True:
+			time.sleep(options.watch_interval)
+			changed = []
+			for path in watched:
+				state = tree_state(path)
+				if state != states[path]:
+					states[path] = state
+					changed.append(path)
+			if not changed:
+				continue
+
+			start = time.time()
+			try:
+				for path in changed:
+					groups[path] = load_group(path, settings)
+				build_course(collect_projects([groups[path] for path in paths]), options, settings, tmp_dir, cache)
+			except Exception as exc:
+				# The next change may fix it, so we keep watching.
+				logging.error("Failed to rebuild the course after changes in %s: %s", ', '.join(changed), exc)
+				continue
+			print "Rebuilt %(path)s in %(seconds).2f seconds after changes in %(changed)s" % {'path':options.output, 'seconds':time.time() - start, 'changed':', '.join(changed)}
+	except KeyboardInterrupt:
+		pass
+
+
+# The options a job of the build service may set, see BuildService.submit().
+JOB_OPTIONS = ('course_url', 'jobs', 'compression_level', 'gzip_threads', 'bundle_compression', 'max_source_file_size',
+               'max_source_page_size', 'max_archive_size', 'max_archive_members')
+
+
+# The queue of a worker process of a BuildService, which receives the ids of the jobs started.
+_started_jobs = None
+
+def _run_job_init(started_jobs):
+	global _started_jobs
+	_started_jobs = started_jobs
+
+def _run_job(task):
+	"""Builds the course of a job inside a worker process of a BuildService and returns the error message, if any."""
+	(sources, options, job_dir) = task
+	tmp_dir = os.path.join(job_dir, 'tmp')
+	if _started_jobs is not None:
+		_started_jobs.put(os.path.basename(job_dir))
+	try:
+		os.makedirs(tmp_dir)
+		build(sources, options, tmp_dir=tmp_dir)
+		return None
+	except Exception as exc:
+		logging.error("Job %s failed: %s", os.path.basename(job_dir), exc)
+		return "{0}: {1}".format(exc.__class__.__name__, exc)
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class BuildService:
+	"""Builds the courses of the submitted jobs on a pool of worker processes.
+
+	The jobs are queued and run by at most 'workers' processes, which live as long as the service.
+	All jobs share the GIT mirrors, the downloaded archives, the source bundles and the highlighted
+	source in cache_dir, so they only fetch and render what the previous jobs didn't."""
+
+	def __init__(self, options, tmp_dir, workers):
+		self.options = options
+		self.jobs_dir = os.path.join(tmp_dir, 'jobs')
+		ensure_dir(self.jobs_dir)
+		self.cache_dir = os.path.abspath(options.cache_dir or os.path.join(tmp_dir, 'cache'))
+		ensure_dir(self.cache_dir)
+		self.jobs = {}
+		self.lock = threading.Lock()
+		# The workers report each job they pick up, so a job is 'running' until it's finished.
+		self.started_jobs = multiprocessing.Queue()
+		self.pool = multiprocessing.Pool(workers, _run_job_init, (self.started_jobs,))
+		self.started_thread = threading.Thread(target=self._started)
+		self.started_thread.daemon = True
+		self.started_thread.start()
+
+	def submit(self, sources, settings):
+		"""Queues a job building the sources and returns its id. settings may set the JOB_OPTIONS, the other options are those of the service."""
+		if not isinstance(sources, list) or not sources or not all(isinstance(source, basestring) for source in sources):
+			raise ValueError("Expects a non-empty list of sources.")
+		options = copy.copy(self.options)
+		for (key, value) in settings.items():
+			if key not in JOB_OPTIONS:
+				raise ValueError("Unknown option {0}, expects one of {1}.".format(key, ', '.join(JOB_OPTIONS)))
+			# JSON strings are unicode.
+			expected = basestring if key in ('course_url', 'bundle_compression') else int
+			if value is not None and not isinstance(value, expected) or value is None and key != 'course_url':
+				raise ValueError("Option {0} expects a {1}.".format(key, 'string' if expected is basestring else 'number'))
+			setattr(options, key, value)
+		# The workers of the pool can't start processes of their own.
+		options.processes = 1
+		options.incremental = False
+		options.resume = False
+		options.tmp = None
+		options.cache_dir = self.cache_dir
+		error = check_options(options)
+		if error is not None:
+			raise ValueError(error)
+
+		job_id = str(uuid.uuid4())
+		job_dir = os.path.join(self.jobs_dir, job_id)
+		os.makedirs(job_dir)
+		options.output = os.path.join(job_dir, 'course.tar.gz')
+		with self.lock:
+			self.jobs[job_id] = {'id':job_id, 'state':'queued', 'sources':sources, 'submitted':time.time(), 'started':None, 'finished':None, 'error':None}
+		self.pool.apply_async(_run_job, ((sources, options, job_dir),), callback=lambda error: self._finished(job_id, error))
+		logging.info("Queued job %s for %d sources.", job_id, len(sources))
+		return job_id
+
+	def _started(self):
+		for job_id in iter(self.started_jobs.get, None):
+			with self.lock:
+				job = self.jobs.get(job_id)
+				# The job may have finished already, if the results arrive first.
+				if job is None or job['state'] != 'queued':
+					continue
+				job['state'] = 'running'
+				job['started'] = time.time()
+			logging.info("Job %s started.", job_id)
+
+	def _finished(self, job_id, error):
+		with self.lock:
+			job = self.jobs.get(job_id)
+			if job is None:
+				return
+			job['state'] = 'failed' if error is not None else 'done'
+			job['error'] = error
+			job['finished'] = time.time()
+		logging.info("Job %s finished: %s.", job_id, job['state'])
+
+	def status(self, job_id=None):
+		"""Returns a copy of the job job_id, or a list of all jobs. Returns None for an unknown job."""
+		with self.lock:
+			if job_id is None:
+				return sorted((dict(job) for job in self.jobs.values()), key=operator.itemgetter('submitted'))
+			job = self.jobs.get(job_id)
+			return dict(job) if job is not None else None
+
+	def output(self, job_id):
+		"""Returns the path of the archive of a finished job."""
+		return os.path.join(self.jobs_dir, job_id, 'course.tar.gz')
+
+	def delete(self, job_id):
+		"""Forgets a finished job and deletes its archive. Returns False, unless the job is finished."""
+		with self.lock:
+			job = self.jobs.get(job_id)
+			if job is None or job['finished'] is None:
+				return False
+			del self.jobs[job_id]
+		shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+		return True
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+		self.started_jobs.put(None)
+		self.started_thread.join()
+
+
+class BuildRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""The HTTP interface of a BuildService:
+
+	POST /jobs                        {"sources": [...], "options": {"course_url": ...}} queues a job
+	GET /jobs                         lists the jobs
+	GET /jobs/<id>                    returns the state of a job: queued, running, done or failed
+	GET /jobs/<id>/course.tar.gz      returns the course of a finished job
+	DELETE /jobs/<id>                 deletes a finished job"""
+
+	def log_message(self, format, *args):
+		logging.info("%s %s", self.address_string(), format % args)
+
+	def send_json(self, code, data):
+		body = json.dumps(data, indent=2, sort_keys=True)
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def route(self):
+		"Returns the job id and the rest of the path, or None for an unknown path."
+		parts = urlparse.urlparse(self.path).path.strip('/').split('/')
+		if parts[0] != 'jobs' or len(parts) > 3:
+			return None
+		return (parts[1] if len(parts) > 1 else None, parts[2] if len(parts) > 2 else None)
+
+	def do_POST(self):
+		if self.route() != (None, None):
+			return self.send_json(404, {'error':'Unknown path {0}'.format(self.path)})
+		try:
+			length = int(self.headers.getheader('Content-Length', 0))
+			request = json.loads(self.rfile.read(length))
+			if not isinstance(request, dict):
+				raise ValueError("Expects a JSON object.")
+			settings = request.get('options') or {}
+			if not isinstance(settings, dict):
+				raise ValueError("Expects the options as a JSON object.")
+			job_id = self.server.service.submit(request.get('sources'), settings)
+		except ValueError as exc:
+			return self.send_json(400, {'error':str(exc)})
+		self.send_json(202, self.server.service.status(job_id))
+
+	def do_GET(self):
+		route = self.route()
+		if route is None:
+			return self.send_json(404, {'error':'Unknown path {0}'.format(self.path)})
+		(job_id, name) = route
+		service = self.server.service
+		if job_id is None:
+			return self.send_json(200, service.status())
+		job = service.status(job_id)
+		if job is None:
+			return self.send_json(404, {'error':'Unknown job {0}'.format(job_id)})
+		if name is None:
+			return self.send_json(200, job)
+		if name != 'course.tar.gz':
+			return self.send_json(404, {'error':'Unknown path {0}'.format(self.path)})
+		if job['state'] != 'done':
+			return self.send_json(409, {'error':'The job is {0}.'.format(job['state'])})
+		with open(service.output(job_id), 'rb') as f:
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/gzip')
+			self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+			self.send_header('Content-Disposition', 'attachment; filename="course.tar.gz"')
+			self.end_headers()
+			shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+	def do_DELETE(self):
+		route = self.route()
+		if route is None or route[0] is None or route[1] is not None:
+			return self.send_json(404, {'error':'Unknown path {0}'.format(self.path)})
+		if self.server.service.status(route[0]) is None:
+			return self.send_json(404, {'error':'Unknown job {0}'.format(route[0])})
+		if not self.server.service.delete(route[0]):
+			return self.send_json(409, {'error':'The job is still queued or running.'})
+		self.send_json(200, {'id':route[0], 'state':'deleted'})
+
+
+class BuildServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def serve(options, tmp_dir):
+	"""Runs the build service of --serve until Ctrl-C is pressed."""
+	service = BuildService(options, tmp_dir, options.serve_workers)
+	server = BuildServer((options.serve_address, options.serve), BuildRequestHandler)
+	server.service = service
+	print "Serving builds on http://%(address)s:%(port)d/jobs with %(workers)d workers. Press Ctrl-C to stop." % {'address':options.serve_address, 'port':server.server_address[1], 'workers':options.serve_workers}
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.close()
+
+
+def make_parser():
+	"""Returns the parser of the command line arguments."""
 	parser = OptionParser(usage=usage)
+	defaults = Settings()
 	parser.add_option("-u", "--course-url", default=None,
 	                  dest="course_url",
 	                  help="Specifies the public URL of the course. It is used for the inline Pdf viewer using Google-Docs. [default: %default]")
@@ -586,6 +2845,9 @@ def main():
 	parser.add_option("-o", "--output", default="to_import.tar.gz",
 	                  metavar="FILE", dest="output",
 	                  help="Specifies the filename of the generated edx-file relative to the working directory. [default: %default]")
+	parser.add_option("-j", "--jobs", default=1, type="int",
+	                  metavar="N", dest="jobs",
+	                  help="Number of sources to clone, download and extract concurrently. [default: %default]")
 	parser.add_option("--tmp",
 	                  metavar="DIR", dest="tmp",
 	                  help="""Configures the directory to use for the intermediate files.
@@ -593,10 +2855,222 @@ If set, this direcory will not be deleted. If not specified,
 a temporary directory is created by the operating system and deleted.
 """
 	                  )
+	parser.add_option("--cache-dir",
+	                  metavar="DIR", dest="cache_dir",
+	                  help="""Keeps mirrors of the remote GIT repositories and the remote archives in this directory.
+Later runs only fetch the changes instead of cloning or downloading everything again.
+""")
+	parser.add_option("--sources-file",
+	                  metavar="FILE", dest="sources_file",
+	                  help="Reads further sources from FILE, one per line, before the sources given as arguments. Empty lines and lines starting with # are skipped.")
+	parser.add_option("--resume", action="store_true", default=False,
+	                  dest="resume",
+	                  help="""Continues the build of the previous run with the same --tmp directory, e.g. after a crash or after fixing a failed source.
+The remote sources acquired are recorded in journal.jsonl inside the --tmp directory and aren't fetched again. The content items
+rendered by the previous runs are kept inside the --tmp directory like with --incremental, so only the missing groups are rendered.""")
+	parser.add_option("--retries", default=2, type="int",
+	                  metavar="N", dest="retries",
+	                  help="Tries to acquire a failing source N more times, e.g. after a network error. Refused archives aren't tried again. [default: %default]")
+	parser.add_option("--retry-delay", default=1, type="float",
+	                  metavar="SECONDS", dest="retry_delay",
+	                  help="Waits SECONDS before the first retry of a source and twice as long before each further one. [default: %default]")
+	parser.add_option("--max-archive-size", default=MAX_ARCHIVE_SIZE / (1024 * 1024), type="int",
+	                  metavar="MB", dest="max_archive_size",
+	                  help="Refuses remote archives which extract to more than MB megabytes. [default: %default]")
+	parser.add_option("--max-archive-members", default=MAX_ARCHIVE_MEMBERS, type="int",
+	                  metavar="N", dest="max_archive_members",
+	                  help="Refuses remote archives with more than N members. [default: %default]")
+	parser.add_option("--incremental", action="store_true", default=False,
+	                  dest="incremental",
+	                  help="Reuses the generated files of all content items whose input didn't change since the last run. The files are kept inside the --cache-dir or the --tmp directory.")
+	parser.add_option("--shard-size",
+	                  metavar="MB", dest="shard_size", type="int",
+	                  help="""Splits the course by project into several archives of at most MB megabytes, each one a course of its own,
+e.g. to_import-1.tar.gz and to_import-2.tar.gz. The shards are written in parallel and to_import-shards.json lists their groups.
+Each shard has a course number of its own, course-1, course-2 and so on. Import each one into a separate edX course.""")
+	parser.add_option("--watch", action="store_true", default=False,
+	                  dest="watch",
+	                  help="""Keeps running after the course is built and rebuilds it whenever a file of the local sources changes.
+Only the changed content items are rendered again. Fast settings like --compression-level 1 or --tmp give the quickest previews.""")
+	parser.add_option("--watch-interval", default=0.5, type="float",
+	                  metavar="SECONDS", dest="watch_interval",
+	                  help="How often --watch looks for changes. [default: %default]")
+	parser.add_option("-p", "--processes", default=1, type="int",
+	                  metavar="N", dest="processes",
+	                  help="Number of processes rendering the groups in parallel. [default: %default]")
+	parser.add_option("--compression-level", default=9, type="int",
+	                  metavar="N", dest="compression_level",
+	                  help="The gzip compression level of the generated edx-file, from 1 (fastest) to 9 (smallest). [default: %default]")
+	parser.add_option("--gzip-threads", default=1, type="int",
+	                  metavar="N", dest="gzip_threads",
+	                  help="""Compresses the generated edx-file with N threads. The result is a gzip file of several members,
+which gzip, tar and python read like any other. [default: %default]""")
+	parser.add_option("--bundle-compression", default="gz", type="choice", choices=["gz", "none"],
+	                  dest="bundle_compression",
+	                  help="The compression of the archives offered for download by 'source' content, either 'gz' or 'none'. [default: %default]")
+	parser.add_option("--max-source-file-size", default=defaults.source_file_limit / 1024, type="int",
+	                  metavar="KB", dest="max_source_file_size",
+	                  help="Shows at most the first KB kilobytes of each file on a 'source' page. The archive for download is complete. [default: %default]")
+	parser.add_option("--max-source-page-size", default=defaults.source_page_limit / 1024, type="int",
+	                  metavar="KB", dest="max_source_page_size",
+	                  help="Shows at most KB kilobytes of source on a 'source' page and just lists the remaining files. [default: %default]")
+	parser.add_option("--max-static-file-size",
+	                  metavar="MB", dest="max_static_file_size", type="int",
+	                  help="Refuses 'pdf' and 'file' content larger than MB megabytes, unless --asset-url is given. [default: no limit]")
+	parser.add_option("--asset-url",
+	                  metavar="URL", dest="asset_url",
+	                  help="""Links the files larger than --max-static-file-size to URL instead of including them in the course.
+They are collected in the directory to_import-assets next to the output for the upload to URL.""")
+	parser.add_option("--write-queue", default=defaults.write_queue_limit / (1024 * 1024), type="int",
+	                  metavar="MB", dest="write_queue",
+	                  help="Writes the generated files in the background, while up to MB megabytes are queued. 0 writes them synchronously. [default: %default]")
+	parser.add_option("--serve",
+	                  metavar="PORT", dest="serve", type="int",
+	                  help="""Runs a local build service on PORT instead of building the given sources, see BuildRequestHandler for the HTTP interface.
+The jobs share the --cache-dir, or a cache inside the temporary directory, and are built with the other options given here.""")
+	parser.add_option("--serve-address", default="127.0.0.1",
+	                  metavar="ADDRESS", dest="serve_address",
+	                  help="The address the build service listens on. [default: %default]")
+	parser.add_option("--serve-workers", default=2, type="int",
+	                  metavar="N", dest="serve_workers",
+	                  help="Number of jobs the build service runs at the same time. [default: %default]")
+	parser.add_option("--check",
+	                  metavar="FILE", dest="check",
+	                  help="""Only validates the sources, using --jobs threads, and writes a JSON report for each source to FILE, or to the standard output for '-'.
+The exit status is 1, if any source has an error. No course is generated.""")
+	parser.add_option("--profile",
+		                  metavar="FILE", dest="profile",
+		                  help="""Records the time spent on each source, group and content item, together with the bytes written,
+as Chrome trace events to FILE, and prints the slowest groups at the end. Open FILE in chrome://tracing or https://ui.perfetto.dev.""")
+	return parser
+
+
+def check_options(options):
+	"""Returns the error message for the first invalid option, or None if all are valid."""
+	if options.jobs < 1:
+		return "--jobs expects a positive number."
+
+	if options.processes < 1:
+		return "--processes expects a positive number."
+
+	if not 1 <= options.compression_level <= 9:
+		return "--compression-level expects a number from 1 to 9."
+
+	if options.gzip_threads < 1:
+		return "--gzip-threads expects a positive number."
+
+	if options.bundle_compression not in ('gz', 'none'):
+		return "--bundle-compression expects 'gz' or 'none'."
+
+	if options.watch_interval <= 0:
+		return "--watch-interval expects a positive number."
+
+	if options.write_queue < 0:
+		return "--write-queue expects a positive number or 0."
+
+	if options.max_static_file_size is not None and options.max_static_file_size < 0:
+		return "--max-static-file-size expects a positive number."
+
+	if options.asset_url is not None and options.max_static_file_size is None:
+		return "--asset-url needs --max-static-file-size."
+
+	if options.shard_size is not None and options.shard_size < 1:
+		return "--shard-size expects a positive number."
+
+	if options.shard_size is not None and (options.incremental or options.watch):
+		return "--shard-size can't be combined with --incremental or --watch."
+
+	if options.serve_workers < 1:
+		return "--serve-workers expects a positive number."
+
+	# The jobs of --serve are built by build(), which refuses these.
+	if options.serve is not None and (options.shard_size is not None or options.check is not None or options.watch or options.profile is not None):
+		return "--serve can't be combined with --shard-size, --check, --watch or --profile."
+
+	if options.retries < 0:
+		return "--retries expects a positive number or 0."
+
+	if options.retry_delay < 0:
+		return "--retry-delay expects a positive number or 0."
+
+	if options.resume and options.tmp is None:
+		return "--resume needs the --tmp directory of the previous run."
+
+	if options.incremental and options.cache_dir is None and options.tmp is None:
+		return "--incremental needs a --cache-dir or a --tmp directory to keep the generated files."
+
+	return None
+
+
+def default_options(**values):
+	"""Returns the options of the command line with their defaults. values replace the defaults,
+	e.g. default_options(course_url='https://example.org/course', jobs=4)."""
+	options = make_parser().get_default_values()
+	for (name, value) in values.items():
+		if not hasattr(options, name):
+			raise ValueError("Unknown option {0}.".format(name))
+		setattr(options, name, value)
+	return options
+
+
+def build(sources, options=None, fileobj=None, tmp_dir=None):
+	"""Builds the course of the sources inside this process and returns the path of the archive options.output.
+
+	This is the entry point for tools like make.py. options are those of the command line, see default_options(),
+	as far as they apply to a single build. If fileobj is given, the archive is streamed into it and None is returned.
+	The intermediate files are kept inside tmp_dir, or --tmp, or a temporary directory, which is deleted afterwards.
+	The options aren't modified. Raises a ValueError for invalid options, including those of main() only, like --watch,
+	and a SubprocessError if the sources can't be built."""
+	if options is None:
+		options = default_options()
+	error = check_options(options)
+	if error is None:
+		error = next(("--{0} isn't supported by build().".format(name.replace('_', '-'))
+		              for name in ('shard_size', 'check', 'watch', 'profile', 'resume') if getattr(options, name)), None)
+	if error is not None:
+		raise ValueError(error)
+	options = copy.copy(options)
+	if options.cache_dir is not None:
+		options.cache_dir = os.path.abspath(options.cache_dir)
+	settings = Settings.from_options(options)
+
+	work_dir = tmp_dir or options.tmp
+	if work_dir is None:
+		work_dir = tempfile.mkdtemp()
+	ensure_dir(work_dir)
+	try:
+		subprocess_setting = {'stderr':subprocess.PIPE, 'stdout':subprocess.PIPE}
+		archive_limits = (options.max_archive_size * 1024 * 1024, options.max_archive_members)
+		paths = acquire_sources(sources, work_dir, subprocess_setting, options.jobs, options.cache_dir, archive_limits,
+		                        None, options.retries, options.retry_delay)
+		cache = None
+		if options.incremental:
+			cache = RenderCache(os.path.join(options.cache_dir or work_dir, 'render'))
+		build_course(load_projects(paths, settings), options, settings, work_dir, cache, fileobj=fileobj)
+	finally:
+		if tmp_dir is None and options.tmp is None:
+			shutil.rmtree(work_dir, ignore_errors=True)
+	if fileobj is not None:
+		return None
+	return options.output
+
+
+def main():
+
+	global profiler
+
+	# The following block parses the arguments supplied.
+	parser = make_parser()
 	(options, sources) = parser.parse_args()
 
-	global courseURL
-	courseURL = options.course_url
+	if options.sources_file is not None:
+		try:
+			sources = read_sources_file(options.sources_file) + sources
+		except (IOError, UnicodeDecodeError) as exc:
+			parser.error("Can't read the --sources-file: {0}".format(exc))
+
+	if options.profile is not None:
+		profiler = Profiler()
 
 	# Setting up the logging facility.
 	log_level = logging.WARNING
@@ -606,7 +3080,8 @@ a temporary directory is created by the operating system and deleted.
 		log_level = logging.DEBUG
 
 	fmt = LoggingFormatter()
-	hdlr = logging.StreamHandler(sys.stdout)
+	# The report of --check may take the standard output.
+	hdlr = logging.StreamHandler(sys.stderr if options.check == '-' else sys.stdout)
 	hdlr.setFormatter(fmt)
 	logging.root.addHandler(hdlr)
 	logging.root.setLevel(log_level)
@@ -617,11 +3092,29 @@ a temporary directory is created by the operating system and deleted.
 	logging.debug("Sources %s", sources)
 
 
-	if len(sources) == 0:
+	if len(sources) == 0 and options.serve is None:
 		logging.error("Expects least one source.")
 		parser.print_help()
 		sys.exit(1)
 
+	error = check_options(options)
+	if error is not None:
+		parser.error(error)
+	# Keeps the cached paths valid independent of the working directory.
+	if options.cache_dir is not None:
+		options.cache_dir = os.path.abspath(options.cache_dir)
+
+	# requests is not a core module.
+	if any(not os.path.exists(source) and source.endswith(('zip', 'tar.gz')) for source in sources):
+		try:
+			import requests
+		except ImportError: 
+			print """ERROR: The module requests is required but missing for remote archives. You can install it with the following commands:
+$ easy_install pip
+$ pip install requests
+"""
+			sys.exit(1)
+
 	
 	try:
 		# Setup of our temorary directory, where we do all the file processing.
@@ -634,169 +3127,74 @@ a temporary directory is created by the operating system and deleted.
 		logging.debug("Temporary directory: %s", tmp_dir)
 
 
-		# The strategy is as follows:
-		# projects is a dictionary with the project name as the key and a list of groups as values.
-		# When all groups are loaded, we transform the dict into a tuple, sort it and sort all the groups inside each project.
-		projects = {}
-
-
 		# If we are verbose, we print stdout/stderr of subprocesses (GIT).
 		subprocess_setting = {'stderr':subprocess.PIPE, 'stdout':subprocess.PIPE}
 		if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
 			subprocess_setting = {'stderr':None, 'stdout':None}
 
-		# We now load each source.
-		for source in sources:
-			if not os.path.exists(source):
-				if source.endswith(('zip', 'tar.gz')):
-					logging.info("Assuming that %s is a remote archive.", source)
-
-					# requests is not a core module.
-					try:
-						import requests
-					except ImportError: 
-						print """ERROR: The module requests is required but missing for remote archives. You can install it with the following commands:
-$ easy_install pip
-$ pip install requests
-"""
-						sys.exit(1)
-
-					# We need a 'unique' directory for the local checkout
-					dest = str(uuid.uuid4())
-					local_path = os.path.join(tmp_dir, dest)
-					os.makedirs(local_path)
-
-					# Wen need the file-extension of the remote file
-					o = urlparse.urlparse(source)
-					(_ , filename_compressed) = os.path.split(o.path)
-					archive_path = os.path.join(local_path, filename_compressed)
-					logging.info("Downloading remote archive to %s.", archive_path);
-
-					with open(archive_path, 'wb') as handle:
-						request = requests.get(source, stream=True)
-						# Raise in case of server/network problems: (4xx, 5xx, ...)
-						request.raise_for_status()
-
-						for block in request.iter_content(1024):
-							if not block:
-								break
-							handle.write(block)
-
-					if archive_path.endswith('.zip'):
-						# We use the external unzip utility.
-						logging.info("Unzip %s", source)
-						try:
-							p = subprocess.Popen(['unzip', archive_path], cwd=local_path, **subprocess_setting)
-							p.wait()
-							if p.returncode != 0:
-								logging.error("Failed to unzip  %s", source)
-								raise SubprocessError("Failed to unzip %s".format(source))
-
-						except OSError:
-							logging.error("unzip not found. Do you have unzip installed?")
-							raise
-
-					if archive_path.endswith('.tar.gz'):
-						# We use the external untar utility.
-						logging.info("untar %s", source)
-						try:
-							p = subprocess.Popen(['tar', '-zxvf', archive_path], cwd=local_path, **subprocess_setting)
-							p.wait()
-							if p.returncode != 0:
-								logging.error("Failed to untar  %s", source)
-								raise SubprocessError("Failed to untar %s".format(source))
-
-						except OSError:
-							logging.error("tar not found. Do you have tar installed?")
-							raise
-
-					# We search for a file called group.yaml, which gives us the directory to process
-					path = None
-					for dirname, dirnames, filenames in os.walk(local_path):
-
-						# Process each file
-						for filename in filenames:
-							if filename == 'group.yaml':
-								logging.debug("Found a group.yaml file inside %s.", dirname)
-								path = dirname
-					if path==None:
-						logging.error("No group.yaml file found in %s", source)
-						raise SubprocessError("No group.yaml file found in %s".format(source))
-
-
-				else:
-					logging.info("There is no directory %s. Assuming that it's a remote GIT repository.", source)
-					# We need a 'unique' directory for the local checkout
-					dest = str(uuid.uuid4())
-					path = os.path.join(tmp_dir, dest)
-
-					logging.warning("Cloning %s", source)
-					try:
-						p = subprocess.Popen(['git', 'clone', source, dest], cwd=tmp_dir, **subprocess_setting)
-						p.wait()
-						if p.returncode != 0:
-							logging.error("Failed to clone GIT repository %s", source)
-							raise SubprocessError("Failed to clone GIT repository %s".format(source))
-
-					except OSError:
-						logging.error("GIT not found. Do you have GIT installed?")
-						raise
+		settings = Settings.from_options(options)
+
+		if options.serve is not None:
+			serve(options, tmp_dir)
+			return
+
+		archive_limits = (options.max_archive_size * 1024 * 1024, options.max_archive_members)
+
+		if options.check is not None:
+			reports = check_sources(sources, tmp_dir, subprocess_setting, options.jobs, options.cache_dir, archive_limits, settings)
+			for report in reports:
+				for error in report['errors']:
+					logging.error("%s: %s", report['source'], error)
+				for warning in report['warnings']:
+					logging.warning("%s: %s", report['source'], warning)
+			result = {'ok':all(report['ok'] for report in reports), 'sources':reports}
+			if options.check == '-':
+				json.dump(result, sys.stdout, indent=2, sort_keys=True)
+				sys.stdout.write('\n')
 			else:
-				path = source
-
-
-			logging.info("Processing %s", path)
-			# We load the group definition and add it to the corresponding group.
-			g = Group(path)
-			g.load()
-			if g.project() not in projects:
-				projects[g.project()] = Project(g.project())
-			projects[g.project()].append(g)
-
-
-		# Sort the projects alphabetically
-		projects = projects.values()
-		list.sort(projects, key=operator.attrgetter('project'))
-		
+				with open(options.check, 'w') as f:
+					json.dump(result, f, indent=2, sort_keys=True)
+			logging.info("%d of %d sources are valid.", sum(report['ok'] for report in reports), len(reports))
+			if not result['ok']:
+				sys.exit(1)
+			return
+
+		# With --tmp, the progress is recorded in a journal, which --resume continues.
+		journal = None
+		if options.tmp is not None:
+			journal = Journal(os.path.join(tmp_dir, 'journal.jsonl'), options.resume)
+			if options.resume:
+				logging.info("Resuming with %d acquired sources and %d rendered groups from the journal.", len(journal.acquired), len(journal.rendered))
+
+		# We now acquire each source. The paths are returned in the order of the sources, independent of --jobs.
+		with span('acquire', 'stage'):
+			paths = acquire_sources(sources, tmp_dir, subprocess_setting, options.jobs, options.cache_dir, archive_limits,
+			                        journal, options.retries, options.retry_delay)
+
+		with span('load', 'stage'):
+			projects = load_projects(paths, settings)
+
+		# With --incremental, the unchanged content items are copied from the previous run.
+		# --watch and --tmp keep them in the temporary directory, unless a --cache-dir is given, so --resume only renders the missing groups.
+		cache = None
+		if options.incremental or options.watch or journal is not None:
+			cache = RenderCache(os.path.join(options.cache_dir or tmp_dir, 'render'))
 
 		# We now have successfully read all groups and we proceed to create the edx course.
+		if options.shard_size is not None:
+			build_shards(projects, options, settings, tmp_dir)
+		else:
+			build_course(projects, options, settings, tmp_dir, cache, journal)
 
-		# Setup the edx directory structure 
-		# All the other files and directories inside are uuid named. We don't have to fear a name clash.
-		out_dir = os.path.join(tmp_dir, 'display_name')
-		# Delete the output directory, if it already exists
-		if os.path.exists(out_dir):
-			shutil.rmtree(out_dir)
-		os.makedirs(out_dir)
-
-		# Create course.xml
-		course = Element('course');
-		course.set('url_name', 'url_name')
-		course.set('org', 'org')
-		course.set('course', 'course')
-		tree = ElementTree(course)
-		tree.write(os.path.join(out_dir, "course.xml"))
-
-		# Create course/course.xml
-		course_dir = os.path.join(out_dir, 'course')
-		os.makedirs(course_dir)
-		course = Element('course');
-		course.set('display_name', 'display_name')
-		for project in projects:
-			e = SubElement(course, 'chapter')
-			e.set('url_name', project.url_name())
-		tree = ElementTree(course)
-		tree.write(os.path.join(course_dir, "{0}.xml".format('url_name')) )				
+		if journal is not None:
+			journal.close()
 
-		# Let each project and implicitly each group create it's files
-		for project in projects:
-			project.edx(out_dir)
+		if profiler is not None:
+			profiler.save(options.profile)
+			profiler.summary()
 
-		# Archive the directory to the output file
-		print "Creating the archive %(path)s" % { 'path':options.output}
-		tar = tarfile.open(options.output, "w:gz")
-		tar.add(out_dir, arcname=os.path.basename(out_dir))
-		tar.close()
+		if options.watch:
+			watch(sources, paths, projects, options, settings, tmp_dir, cache)
 
 
 	# If any expection occurs, we still want to delete the temporary directory.
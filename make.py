@@ -11,12 +11,56 @@ import logging
 # Packages for file and process operatons
 import os
 import tarfile
-import subprocess
+import gzip
+import io
 import shutil
 import tempfile
 
 # misc
 import uuid
+import imp
+
+
+(script_directory , filename) = os.path.split(os.path.realpath(__file__))
+
+# The script has a dash in its name, so it can't be imported by the import statement.
+presenter = imp.load_source('edx_presenter', os.path.join(script_directory, 'edx-presenter.py'))
+
+
+def tar_members(path, arcname, exclude=None):
+	"""Returns the tar blocks of the directory path, without the end of the archive, so further members may follow.
+
+	The file 'exclude' inside path is left out."""
+	f = io.BytesIO()
+	tar = tarfile.open(fileobj=f, mode='w')
+	excluded = None
+	if exclude is not None:
+		excluded = os.path.join(arcname, exclude)
+	tar.add(path, arcname=arcname, filter=lambda info: None if info.name == excluded else info)
+	# Closing the tar would end the archive.
+	return f.getvalue()
+
+
+def tar_end(members):
+	"""Returns the tar blocks of the members, a list of (arcname, path), followed by the end of the archive."""
+	f = io.BytesIO()
+	tar = tarfile.open(fileobj=f, mode='w')
+	for (arcname, path) in members:
+		tar.add(path, arcname=arcname)
+	tar.close()
+	return f.getvalue()
+
+
+def gzip_member(data):
+	"""Returns data as a complete gzip member.
+
+	A concatenation of gzip members is a valid gzip file (RFC 1952), so archives sharing their first
+	members are concatenated from the same compressed bytes instead of being compressed again."""
+	f = io.BytesIO()
+	gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9)
+	gz.write(data)
+	gz.close()
+	return f.getvalue()
 
 
 
@@ -41,6 +85,9 @@ if options.verbose == 1:
 elif options.verbose >= 2:
 	log_level = logging.DEBUG
 logging.root.setLevel(log_level)
+hdlr = logging.StreamHandler()
+hdlr.setFormatter(presenter.LoggingFormatter())
+logging.root.addHandler(hdlr)
 
 
 # When debugging, it's always good to know the values of the following variables:
@@ -57,8 +104,6 @@ else:
 logging.debug("tmp directory %s", tmp_dir)
 
 
-(script_directory , filename) = os.path.split(os.path.realpath(__file__))
-
 # Copy the template of the edx-presenter
 edx_dir = os.path.join(tmp_dir,'edx-presenter')
 shutil.copytree(os.path.join(script_directory, 'presentations','edx-presenter'), edx_dir)
@@ -81,29 +126,38 @@ tar.add(skeleton_path, arcname=os.path.basename(skeleton_path))
 tar.close()
 
 
-# Compress the edx-presenter dir and add it to itself
+# Compress the edx-presenter dir and add it to itself.
+# Both archives only differ in their last member, files/edx-presenter.tar.gz. The other members are
+# compressed once, the archive added to itself contains the edx-presenter.tar.gz of the template.
+arcname = os.path.basename(edx_dir)
+archive_name = os.path.join('files', 'edx-presenter.tar.gz')
+archive_presenter = os.path.join(edx_dir, archive_name)
+head = gzip_member(tar_members(edx_dir, arcname, archive_name))
+
 tmp_archive_presenter = os.path.join(tmp_dir, 'edx-presenter.tar.gz')
-tar = tarfile.open(tmp_archive_presenter, "w:gz")
-tar.add(edx_dir, arcname=os.path.basename(edx_dir))
-tar.close()
+with open(tmp_archive_presenter, 'wb') as f:
+	f.write(head)
+	members = []
+	if os.path.exists(archive_presenter):
+		members.append((os.path.join(arcname, archive_name), archive_presenter))
+	f.write(gzip_member(tar_end(members)))
 
-archive_presenter = os.path.join(edx_dir, 'files', 'edx-presenter.tar.gz')
 if os.path.exists(archive_presenter):
 	os.remove(archive_presenter)
 shutil.copyfile(tmp_archive_presenter, archive_presenter)
 
 
 # Compress the edx-project for output
-tar = tarfile.open('edx-presenter.tar.gz', "w:gz")
-tar.add(edx_dir, arcname=os.path.basename(edx_dir))
-tar.close()
+with open('edx-presenter.tar.gz', 'wb') as f:
+	f.write(head)
+	f.write(gzip_member(tar_end([(os.path.join(arcname, archive_name), archive_presenter)])))
 
 
-# Run the edx-presenter script
-p = subprocess.Popen([os.path.join(script_directory,'edx-presenter.py'), '-v', edx_dir, os.path.join(script_directory,'presentations','skeleton')])
-p.wait()
-if p.returncode != 0:
-	logging.error("Failed to create the edx-file")
+# Build the course in this process. It includes the archives just created as they are.
+try:
+	presenter.build([edx_dir, skeleton_path], presenter.default_options(), tmp_dir=os.path.join(tmp_dir, 'build'))
+except Exception as exc:
+	logging.error("Failed to create the edx-file: %s", exc)
 
 
 # Delete the temp-dir
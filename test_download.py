@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run the tests with: python test_download.py
+
+"""
+Tests the downloads of remote archives of edx-presenter.py against a local HTTP server.
+
+The server stands in for the host of the archives. It answers conditional requests with
+'304 Not Modified', resumes with Range requests and may drop or stall a transfer halfway.
+"""
+
+
+# Logging functionality of python.
+import logging
+
+# Packages for file and process operatons
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+# The local HTTP server
+import BaseHTTPServer
+import SocketServer
+
+# misc
+import imp
+import hashlib
+import time
+
+
+(script_directory , filename) = os.path.split(os.path.realpath(__file__))
+
+# The script has a dash in its name, so it can't be imported by the import statement.
+presenter = imp.load_source('edx_presenter', os.path.join(script_directory, 'edx-presenter.py'))
+
+
+class ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves server.payload under any path, see ArchiveServer."""
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		server = self.server
+		server.requests.append(dict(self.headers))
+		payload = server.payload
+		etag = '"{0}"'.format(hashlib.sha1(payload).hexdigest())
+
+		if self.headers.get('If-None-Match') == etag:
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		offset = 0
+		status = 200
+		requested = self.headers.get('Range')
+		# A Range request is only answered partially, if the file is still the one of the ETag in If-Range.
+		if requested is not None and self.headers.get('If-Range') == etag:
+			offset = int(requested[len('bytes='):].rstrip('-'))
+			status = 206
+		body = payload[offset:]
+
+		self.send_response(status)
+		self.send_header('ETag', etag)
+		self.send_header('Content-Length', str(len(body)))
+		if status == 206:
+			self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(offset, len(payload) - 1, len(payload)))
+		self.end_headers()
+
+		# The next transfer is interrupted after half of its body, if the test asks for it.
+		interrupt = server.interrupt
+		server.interrupt = None
+		if interrupt is None:
+			self.wfile.write(body)
+			return
+		self.wfile.write(body[:len(body) // 2])
+		self.wfile.flush()
+		if interrupt == 'stall':
+			time.sleep(server.stall_seconds)
+		self.close_connection = True
+
+	def log_message(self, format, *args):
+		pass
+
+
+class ArchiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, payload):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ArchiveHandler)
+		self.payload = payload
+		# None, 'drop' or 'stall' for the next transfer.
+		self.interrupt = None
+		self.stall_seconds = 3
+		self.requests = []
+
+	def url(self, name='archive.tar.gz'):
+		return 'http://127.0.0.1:{0}/{1}'.format(self.server_address[1], name)
+
+
+class DownloadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		# The download reads blocks of COPY_BUFFER_SIZE, so an interrupted transfer keeps at least one of them.
+		self.payload = os.urandom(3 * presenter.COPY_BUFFER_SIZE)
+		self.server = ArchiveServer(self.payload)
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.timeout = presenter.DOWNLOAD_TIMEOUT
+		self.resumes = presenter.DOWNLOAD_RESUMES
+
+	def tearDown(self):
+		presenter.DOWNLOAD_TIMEOUT = self.timeout
+		presenter.DOWNLOAD_RESUMES = self.resumes
+		# Closes the connections kept by the session, so the threads of the server finish.
+		presenter.http_session().close()
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.tmp_dir)
+
+	def read(self, path):
+		with open(path, 'rb') as f:
+			return f.read()
+
+	def test_download(self):
+		path = os.path.join(self.tmp_dir, 'archive.tar.gz')
+		(response, digest) = presenter.download(self.server.url(), path)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(digest, hashlib.sha256(self.payload).hexdigest())
+		self.assertEqual(self.read(path), self.payload)
+		self.assertFalse(os.path.exists(path + '.validator'))
+
+	def test_resume_after_drop(self):
+		self.server.interrupt = 'drop'
+		path = os.path.join(self.tmp_dir, 'archive.tar.gz')
+		(response, digest) = presenter.download(self.server.url(), path)
+		self.assertEqual(self.read(path), self.payload)
+		self.assertEqual(digest, hashlib.sha256(self.payload).hexdigest())
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertIn('range', self.server.requests[1])
+		self.assertEqual(response.status_code, 206)
+
+	def test_resume_after_stall(self):
+		presenter.DOWNLOAD_TIMEOUT = (1, 1)
+		self.server.interrupt = 'stall'
+		path = os.path.join(self.tmp_dir, 'archive.tar.gz')
+		(response, digest) = presenter.download(self.server.url(), path)
+		self.assertEqual(self.read(path), self.payload)
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertIn('range', self.server.requests[1])
+		self.assertEqual(response.status_code, 206)
+
+	def test_restart_after_change(self):
+		# The kept part belongs to an older version of the file, so the server sends the new one from the start.
+		path = os.path.join(self.tmp_dir, 'archive.tar.gz')
+		with open(path, 'wb') as f:
+			f.write(self.payload[:1000])
+		with open(path + '.validator', 'w') as f:
+			f.write('"outdated"')
+		(response, digest) = presenter.download(self.server.url(), path)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.read(path), self.payload)
+
+	def test_cached_archive_revalidation(self):
+		cache_dir = os.path.join(self.tmp_dir, 'cache')
+		(archive_path, digest) = presenter.download_cached_archive(self.server.url(), cache_dir)
+		self.assertEqual(self.read(archive_path), self.payload)
+
+		# An unchanged archive is revalidated with a '304 Not Modified'.
+		self.assertEqual(presenter.download_cached_archive(self.server.url(), cache_dir), (archive_path, digest))
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertIn('if-none-match', self.server.requests[1])
+
+		# A changed archive is downloaded again and stored under its new digest.
+		self.server.payload = os.urandom(1024)
+		(changed_path, changed_digest) = presenter.download_cached_archive(self.server.url(), cache_dir)
+		self.assertNotEqual(changed_digest, digest)
+		self.assertEqual(self.read(changed_path), self.server.payload)
+
+	def test_cached_archive_resume(self):
+		# The partial file of an interrupted run is resumed by the next one.
+		cache_dir = os.path.join(self.tmp_dir, 'cache')
+		self.server.interrupt = 'drop'
+		presenter.DOWNLOAD_RESUMES = 0
+		self.assertRaises(presenter.SubprocessError, presenter.download_cached_archive, self.server.url(), cache_dir)
+		presenter.DOWNLOAD_RESUMES = self.resumes
+		(archive_path, digest) = presenter.download_cached_archive(self.server.url(), cache_dir)
+		self.assertEqual(self.read(archive_path), self.payload)
+		self.assertIn('range', self.server.requests[-1])
+
+
+if __name__ == '__main__':
+	logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+	unittest.main()